@@ -0,0 +1,207 @@
+"""asyncio serving mode.
+
+Serves the same app as main.py, but Socket.IO runs on python-socketio's
+AsyncServer and AI replies await the async generative API instead of
+occupying a pool thread each. The Flask routes are mounted unchanged through
+an ASGI adapter and share main.py's room store, caches and metrics. main.py's
+broadcaster, generation pool and close_room are pointed at this server, so
+/metrics and /v1/stats report what it is doing.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import time
+from http.cookies import SimpleCookie
+
+import socketio
+from asgiref.wsgi import WsgiToAsgi
+
+import main
+from main import app as flask_app, broadcaster, rooms, response_cache, single_flight
+from main import ReplyStream, call_model_async, emit_reply, event_ids, model_notice, plan_reply, record_reply
+from main import reply_failed, shared_reply, timed_model_call
+from serving import delete_connection, new_connection
+from serving import AsyncGenerationPool, Busy, MSG, NOTICE
+
+if flask_app.config['SOCKETIO_MESSAGE_QUEUE']:
+    client_manager = socketio.AsyncRedisManager(flask_app.config['SOCKETIO_MESSAGE_QUEUE'])
+else:
+    client_manager = None
+sio = socketio.AsyncServer(async_mode='asgi', client_manager=client_manager)
+loop = None
+
+
+def capture_loop():
+    global loop
+    loop = asyncio.get_running_loop()
+
+
+def emit_frames(target, frames):
+    # Called from the broadcaster's flush thread as well as from handlers on the loop.
+    asyncio.run_coroutine_threadsafe(sio.emit('ev', frames, to=target), loop)
+
+
+app = socketio.ASGIApp(sio, other_asgi_app=WsgiToAsgi(flask_app), on_startup=capture_loop)
+main.emit_frames = emit_frames
+main.generation_pool = AsyncGenerationPool(
+    max_workers=flask_app.config['ASYNC_MAX_GENERATIONS'],
+    max_queued=flask_app.config['GENERATION_MAX_QUEUED'],
+    max_per_room=flask_app.config['GENERATION_MAX_PER_ROOM'],
+    on_position=main.send_queue_position,
+)
+
+
+def close_room(room, notice):
+    # Called from the reaper and from /v1 request threads, never from the loop.
+    # The notice's emit is scheduled first, so it reaches members before they are removed.
+    broadcaster.direct(room, NOTICE, notice)
+    asyncio.run_coroutine_threadsafe(sio.close_room(room), loop)
+
+
+main.close_room = close_room
+
+
+def load_session(environ):
+    cookie = SimpleCookie(environ.get('HTTP_COOKIE', ''))
+    morsel = cookie.get(flask_app.config.get('SESSION_COOKIE_NAME', 'session'))
+    if morsel is None:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(morsel.value)
+    except Exception:
+        return {}
+
+
+@sio.event
+async def connect(sid, environ):
+    main.socket_events.inc('connect')
+    session = load_session(environ)
+    name, room = session.get('name'), session.get('room')
+    if name is None or room is None:
+        return False
+    # The room store may be SQLite or Redis, so its calls run off the loop.
+    try:
+        await asyncio.to_thread(rooms.add_member, room)
+    except KeyError:
+        return False
+
+    await sio.save_session(sid, {'name': name, 'room': room})
+    await sio.enter_room(sid, room)
+    broadcaster.join(room, sid)
+    broadcaster.publish(room, NOTICE, "Welcome! The bot may take some time to generate a response depending on the length of the prompt.")
+    main.reaper.touch(room)
+    new_connection("New Connection established. Room: {0}".format(room), room=room)
+
+
+@sio.event
+async def message(sid, payload):
+    started = time.perf_counter()
+    main.socket_events.inc('message')
+    session = await sio.get_session(sid)
+    room, name = session.get('room'), session.get('name')
+    message = {
+        "sender": name,
+        "message": payload["message"]
+    }
+    try:
+        await asyncio.to_thread(rooms.append_message, room, message)
+    except KeyError:
+        return
+    broadcaster.publish(room, MSG, message["message"], sender=name)
+    main.reaper.touch(room)
+
+    # Only admitted once the model is ready, so nothing below waits on it from the loop.
+    notice = model_notice()
+    if notice is not None:
+        broadcaster.direct(sid, NOTICE, notice)
+        return
+    prompt = str(payload['message'])
+    try:
+        main.generation_pool.submit(room, lambda: generate_reply(room, prompt, started), ticket=next(event_ids))
+    except Busy:
+        broadcaster.direct(sid, NOTICE, "AIBot is busy right now, please try again in a moment.")
+
+
+async def generate_reply(room, prompt, started):
+    try:
+        text = await reply(room, prompt)
+        # record_reply checks the room store.
+        await asyncio.to_thread(record_reply, room, prompt, text)
+    finally:
+        main.message_latency.observe(time.perf_counter() - started)
+
+
+# Async drivers for main.py's reply helpers; the policy (and error handling) lives there.
+async def reply(room, prompt):
+    # plan_reply reads the room store, which may be SQLite or Redis.
+    profile, contents, key = await asyncio.to_thread(plan_reply, room, prompt)
+    if key is None:
+        return await produce_reply(room, None, contents, profile)
+    text = response_cache.get(key)
+    if text is not None:
+        emit_reply(room, text)
+        return text
+
+    future, leader = await single_flight.do_async(key, lambda: produce_reply(room, key, contents, profile))
+    if not leader:
+        # Wait without raising, so shared_reply reports a failed leader as main.py does.
+        await asyncio.wait([asyncio.wrap_future(future)])
+    return shared_reply(room, future, emit=not leader)
+
+
+async def produce_reply(room, key, contents, profile):
+    if flask_app.config['STREAM_REPLIES']:
+        text = await stream_reply(room, contents, profile)
+    else:
+        text = await complete_reply(room, contents, profile)
+    if text is not None and key is not None:
+        # set() can write the cache file to disk.
+        await asyncio.to_thread(response_cache.set, key, text)
+    return text
+
+
+async def complete_reply(room, contents, profile):
+    try:
+        with timed_model_call():
+            response = await call_model_async(contents, profile)
+        text = response.text
+    except Exception as e:
+        return reply_failed(room, e)
+    emit_reply(room, text)
+    return text
+
+
+async def stream_reply(room, contents, profile):
+    stream = ReplyStream(room)
+    try:
+        with timed_model_call():
+            async for chunk in await call_model_async(contents, profile, stream=True):
+                stream.add(chunk.text)
+    except Exception as e:
+        return stream.fail(e)
+    return stream.finish()
+
+
+@sio.event
+async def disconnect(sid):
+    main.socket_events.inc('disconnect')
+    session = await sio.get_session(sid)
+    room = session.get('room')
+    if room is None:
+        return
+    await sio.leave_room(sid, room)
+
+    try:
+        members = await asyncio.to_thread(rooms.add_member, room, -1)
+    except KeyError:
+        return
+    if members <= 0:
+        await asyncio.to_thread(main.drop_room, room)
+        delete_connection('Room deletion: {0}'.format(room), room=room)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=5000)
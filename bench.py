@@ -0,0 +1,300 @@
+"""Load generator for the chat server.
+
+Spins up simulated clients across rooms, walks the same flow a browser does
+(POST / to create a room, GET /room, then Socket.IO connect/message/disconnect)
+and reports time-to-reply percentiles, throughput, error rate and server RSS.
+
+The app has no way to join an existing room, so the first client of each room
+creates it and the rest reuse that client's session cookie.
+
+    python bench.py --spawn --clients 50 --rooms 10 --rate 0.5 --duration 30
+
+With --spawn the server runs against the offline fake backend (AI_BACKEND=fake)
+unless AI_BACKEND is already set, so only our own overhead is measured; tune
+it with the FAKE_AI_* variables, e.g. FAKE_AI_LATENCY=lognormal:-1,0.5.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+import requests
+import socketio
+
+REPLY_ERROR = "Sorry, I couldn't answer that. Please try again."
+# Frame types of the server's compact room protocol (see utils.RoomBroadcaster).
+MSG, NOTICE, QUEUE, CHUNK, SENDER = range(5)
+BUSY_PREFIX = "AIBot is busy right now"
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.replies = []
+        self.first_chunks = []
+        self.errors = 0
+        self.rejected = 0
+        self.connect_failures = 0
+
+    def record(self, attr, value=None):
+        with self.lock:
+            if value is None:
+                setattr(self, attr, getattr(self, attr) + 1)
+            else:
+                getattr(self, attr).append(value)
+
+
+class Room:
+    """Matches replies to sends; the server answers each room's prompts in order."""
+
+    def __init__(self, code, stats):
+        self.code = code
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.streaming = {}
+
+    def sent(self, client_id):
+        with self.lock:
+            self.pending.append((client_id, time.perf_counter()))
+        self.stats.record('sent')
+
+    def rejected(self, client_id):
+        with self.lock:
+            for i, (owner, _) in enumerate(self.pending):
+                if owner == client_id:
+                    del self.pending[i]
+                    break
+        self.stats.record('rejected')
+
+    def replied(self, text):
+        with self.lock:
+            if not self.pending:
+                return
+            _, started = self.pending.popleft()
+        if text == REPLY_ERROR:
+            self.stats.record('errors')
+        else:
+            self.stats.record('replies', time.perf_counter() - started)
+
+    def chunk(self, chunk):
+        # Chunks of one reply share an id; only the first is timed for time-to-first-token.
+        if chunk['id'] not in self.streaming:
+            self.streaming[chunk['id']] = True
+            with self.lock:
+                started = self.pending[0][1] if self.pending else None
+            if started is not None:
+                self.stats.record('first_chunks', time.perf_counter() - started)
+        if chunk.get('done'):
+            self.streaming.pop(chunk['id'], None)
+            self.replied(chunk['text'] or None)
+
+
+class Client:
+    def __init__(self, client_id, base_url, room, cookies, observer):
+        self.client_id = client_id
+        self.base_url = base_url
+        self.room = room
+        self.http = requests.Session()
+        self.http.cookies.update(cookies)
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('ev', self.on_frames)
+        # Every member sees every reply, so one client per room does the bookkeeping.
+        self.observer = observer
+        self.senders = {}
+
+    def on_frames(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            import msgpack
+
+            data = msgpack.unpackb(data)
+        for kind, _, sender_id, payload in data:
+            if kind == SENDER:
+                self.senders[sender_id] = payload
+            elif kind == NOTICE and payload.startswith(BUSY_PREFIX):
+                self.room.rejected(self.client_id)
+            elif not self.observer:
+                continue
+            elif kind == MSG and self.senders.get(sender_id, sender_id) == 'AIBot':
+                self.room.replied(payload)
+            elif kind == CHUNK:
+                message_id, seq, text, done = payload
+                self.room.chunk({'id': message_id, 'seq': seq, 'text': text, 'done': done})
+
+    def connect(self):
+        self.http.get(self.base_url + '/room').raise_for_status()
+        cookie = '; '.join('{0}={1}'.format(k, v) for k, v in self.http.cookies.items())
+        self.sio.connect(self.base_url, headers={'Cookie': cookie})
+
+    def run(self, rate, deadline, prompts):
+        i = 0
+        while time.monotonic() < deadline:
+            self.room.sent(self.client_id)
+            self.sio.emit('message', {'message': prompts[i % len(prompts)]})
+            i += 1
+            time.sleep(1 / rate)
+
+    def close(self):
+        self.sio.disconnect()
+
+
+def create_room(base_url, name):
+    http = requests.Session()
+    # The POST redirects to /room, which shows the new room's code.
+    response = http.post(base_url + '/', data={'name': name, 'create': 'create'})
+    response.raise_for_status()
+    match = re.search(r'Room Code: <span>(\w+)</span>', response.text)
+    return http.cookies.get_dict(), match and match.group(1)
+
+
+def rss_bytes(pid):
+    try:
+        with open('/proc/{0}/status'.format(pid)) as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process(pid).memory_info().rss
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def wait_for_server(base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # /ready answers 503 until the model has loaded; servers without it answer 404.
+            if requests.get(base_url + '/ready', timeout=1).status_code != 503:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit('Server at {0} did not come up'.format(base_url))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=0.5, help='messages per second per client')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to send for')
+    parser.add_argument('--drain', type=float, default=30, help='seconds to wait for outstanding replies')
+    parser.add_argument('--spawn', action='store_true', help='start main.py locally and measure its RSS')
+    parser.add_argument('--server-pid', type=int, help='pid of an already running server, for RSS')
+    parser.add_argument('--prompt', action='append', help='prompt to send (repeatable)')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.spawn:
+        # No debug reloader, so the pid we measure is the process serving requests.
+        env = dict(os.environ, FLASK_DEBUG='0')
+        env.setdefault('AI_BACKEND', 'fake')
+        main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+        server = subprocess.Popen([sys.executable, main_py], env=env)
+        args.server_pid = server.pid
+    try:
+        wait_for_server(args.url, 30)
+        report = run(args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print('{0:>22}: {1}'.format(key, value))
+
+
+def run(args):
+    stats = Stats()
+    prompts = args.prompt or ['What is the meaning of life?', 'How does blockchain technology work?']
+    rooms, clients = [], []
+    for r in range(args.rooms):
+        cookies, code = create_room(args.url, 'bench{0}'.format(r))
+        rooms.append((Room(code, stats), cookies))
+    for i in range(args.clients):
+        room, cookies = rooms[i % args.rooms]
+        client = Client(i, args.url, room, cookies, observer=i < args.rooms)
+        try:
+            client.connect()
+        except Exception:
+            stats.record('connect_failures')
+            continue
+        clients.append(client)
+
+    rss = []
+    stop = threading.Event()
+
+    def sample_rss():
+        while not stop.wait(0.5):
+            if args.server_pid:
+                value = rss_bytes(args.server_pid)
+                if value is not None:
+                    rss.append(value)
+
+    threading.Thread(target=sample_rss, daemon=True).start()
+    started = time.monotonic()
+    deadline = started + args.duration
+    senders = [threading.Thread(target=c.run, args=(args.rate, deadline, prompts)) for c in clients]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+
+    drain_deadline = time.monotonic() + args.drain
+    while time.monotonic() < drain_deadline and any(room.pending for room, _ in rooms):
+        time.sleep(0.1)
+    elapsed = time.monotonic() - started
+    stop.set()
+    for client in clients:
+        client.close()
+
+    unanswered = sum(len(room.pending) for room, _ in rooms)
+    failed = stats.errors + stats.rejected + unanswered
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        'clients': len(clients),
+        'rooms': args.rooms,
+        'connect_failures': stats.connect_failures,
+        'sent': stats.sent,
+        'replies': len(stats.replies),
+        'throughput_per_s': round(len(stats.replies) / elapsed, 2),
+        'p50_reply_ms': ms(percentile(stats.replies, 50)),
+        'p95_reply_ms': ms(percentile(stats.replies, 95)),
+        'p99_reply_ms': ms(percentile(stats.replies, 99)),
+        'p50_first_chunk_ms': ms(percentile(stats.first_chunks, 50)),
+        'p99_first_chunk_ms': ms(percentile(stats.first_chunks, 99)),
+        'errors': stats.errors,
+        'rejected': stats.rejected,
+        'unanswered': unanswered,
+        'error_rate': round(failed / stats.sent, 4) if stats.sent else 0.0,
+        'peak_rss_mb': round(max(rss) / 2 ** 20, 1) if rss else None,
+        'final_rss_mb': round(rss[-1] / 2 ** 20, 1) if rss else None,
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# Puts the repo root on sys.path so tests can import serving.py with plain `pytest`.
@@ -1,29 +1,392 @@
-from flask import Flask, request, render_template, redirect, url_for, session
-from flask_socketio import SocketIO, join_room, leave_room, send
+from flask import Flask, Response, jsonify, request, render_template, redirect, url_for, session
+from flask_socketio import SocketIO, join_room, leave_room
 import requests
+import atexit
+import itertools
+import json
+import os
+import secrets
+import time
+from contextlib import contextmanager
 
-from utils import generate_room_code, aiLib, delete_connection, new_connection, info
+from utils import IMPORT_PROFILE, aiLib, ModelRegistry
+from serving import delete_connection, new_connection, error
+from serving import Busy, ConversationContext, GenerationPool, MetricsRegistry, PromptBatcher, ResponseCache, RoomCodeAllocator, SingleFlight
+from serving import RoomBroadcaster, RoomReaper, make_room_store
+from serving import ProfileSelector, load_profiles
+from serving import MSG, NOTICE, QUEUE, CHUNK
 from utils import *
 
-init(autoreset=True)
-
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'SDKFJSDFOWEIOF'
-socketio = SocketIO(app)
+# memory:// keeps rooms in this process; sqlite:///path or redis://host lets several workers share them.
+app.config['ROOM_STORE'] = os.environ.get('ROOM_STORE', 'memory://')
+# Needed alongside a shared room store so emits reach clients connected to other workers.
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+app.config['HISTORY_MAX_MESSAGES'] = int(os.environ.get('HISTORY_MAX_MESSAGES', 500))
+app.config['HISTORY_MAX_BYTES'] = int(os.environ.get('HISTORY_MAX_BYTES', 256 * 1024))
+app.config['HISTORY_PAGE_SIZE'] = int(os.environ.get('HISTORY_PAGE_SIZE', 50))
+# Room events are coalesced and sent once per tick; 0 sends every event immediately.
+app.config['BROADCAST_TICK_MS'] = float(os.environ.get('BROADCAST_TICK_MS', 10))
+app.config['BROADCAST_MSGPACK'] = os.environ.get('BROADCAST_MSGPACK', '0') == '1'
+app.config['ROOM_IDLE_TTL'] = float(os.environ.get('ROOM_IDLE_TTL', 3600))
+app.config['ROOM_UNJOINED_TTL'] = float(os.environ.get('ROOM_UNJOINED_TTL', 300))
+app.config['REAPER_INTERVAL'] = float(os.environ.get('REAPER_INTERVAL', 5))
+app.config['ADMIN_MAX_BATCH'] = int(os.environ.get('ADMIN_MAX_BATCH', 10000))
+# Bearer token for /v1. With none set the bulk ops are disabled and only the legacy
+# single-room delete works, as it did before tokens existed.
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+app.config['GENERATION_WORKERS'] = int(os.environ.get('GENERATION_WORKERS', 8))
+app.config['GENERATION_MAX_QUEUED'] = int(os.environ.get('GENERATION_MAX_QUEUED', 64))
+app.config['GENERATION_MAX_PER_ROOM'] = int(os.environ.get('GENERATION_MAX_PER_ROOM', 4))
+# Concurrent generations in the asyncio serving mode (asgi.py), which needs no thread per request.
+app.config['ASYNC_MAX_GENERATIONS'] = int(os.environ.get('ASYNC_MAX_GENERATIONS', 256))
+app.config['STREAM_REPLIES'] = os.environ.get('STREAM_REPLIES', '1') == '1'
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+app.config['RESPONSE_CACHE_TTL'] = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+app.config['RESPONSE_CACHE_PATH'] = os.environ.get('RESPONSE_CACHE_PATH')
+# Tokens of room history sent with each prompt; 0 (the default) sends every prompt on its own.
+# With context on, every prompt after a room's first depends on that room's history, so it
+# skips the response cache and single-flight, and long rooms add background summary calls.
+app.config['CONTEXT_TOKENS'] = int(os.environ.get('CONTEXT_TOKENS', 0))
+app.config['CONTEXT_SUMMARY_TOKENS'] = int(os.environ.get('CONTEXT_SUMMARY_TOKENS', 256))
+# A batch window of 0 sends every prompt straight to the backend. There is no batched backend
+# call yet, so batching only caps concurrent non-streaming calls at BATCH_MAX_CONCURRENCY.
+app.config['BATCH_WINDOW_MS'] = float(os.environ.get('BATCH_WINDOW_MS', 0))
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('BATCH_MAX_SIZE', 16))
+app.config['BATCH_MAX_CONCURRENCY'] = int(os.environ.get('BATCH_MAX_CONCURRENCY', 16))
+# JSON list of profile fields (see serving.GenerationProfile), best first; unset uses the built-in three.
+app.config['GENERATION_PROFILES'] = os.environ.get('GENERATION_PROFILES')
+# p95 model latency above which rooms step down to faster profiles; 0 disables it.
+app.config['GENERATION_SLO_MS'] = float(os.environ.get('GENERATION_SLO_MS', 0))
+socketio = SocketIO(app, message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
+
+rooms = make_room_store(
+    app.config['ROOM_STORE'],
+    max_messages=app.config['HISTORY_MAX_MESSAGES'],
+    max_bytes=app.config['HISTORY_MAX_BYTES'],
+)
+# Other workers can create rooms in a shared store, so check it before handing out a code.
+room_codes = RoomCodeAllocator(
+    length=6,
+    taken=None if app.config['ROOM_STORE'].startswith('memory:') else rooms.__contains__,
+)
+room_codes.reserve(rooms.codes())
+
+
+def emit_frames(target, frames):
+    # asgi.py replaces this (and close_room and generation_pool) to serve from its own server.
+    socketio.emit('ev', frames, to=target)
+
+
+broadcaster = RoomBroadcaster(
+    lambda target, frames: emit_frames(target, frames),
+    tick=app.config['BROADCAST_TICK_MS'] / 1000,
+    use_msgpack=app.config['BROADCAST_MSGPACK'],
+    # Sender ids are per worker, so name senders outright when workers share rooms through the queue.
+    intern_senders=not app.config['SOCKETIO_MESSAGE_QUEUE'],
+)
+# Queue tickets and streamed reply ids only need to be unique within a room.
+event_ids = itertools.count(1)
+
+
+def send_queue_position(room, ticket, position):
+    broadcaster.publish(room, QUEUE, [ticket, position])
+
+
+generation_pool = GenerationPool(
+    max_workers=app.config['GENERATION_WORKERS'],
+    max_queued=app.config['GENERATION_MAX_QUEUED'],
+    max_per_room=app.config['GENERATION_MAX_PER_ROOM'],
+    on_position=send_queue_position,
+)
+response_cache = ResponseCache(
+    max_entries=app.config['RESPONSE_CACHE_SIZE'],
+    ttl=app.config['RESPONSE_CACHE_TTL'],
+    path=app.config['RESPONSE_CACHE_PATH'],
+)
+atexit.register(response_cache.save)
+single_flight = SingleFlight()
+
+profiles = load_profiles(app.config['GENERATION_PROFILES'])
+profile_selector = ProfileSelector(profiles, slo=app.config['GENERATION_SLO_MS'] / 1000)
+models = ModelRegistry(aiLib)
+models.check(profile.model for profile in profiles)
+
+
+def call_model(contents, profile=None, **kwargs):
+    if profile is None:
+        return aiLib.generate_content(contents, **kwargs)
+    return models.get(profile.model).generate_content(
+        contents + profile.suffix, generation_config=profile.generation_config(), **kwargs
+    )
+
+
+def call_model_async(contents, profile, **kwargs):
+    return models.get(profile.model).generate_content_async(
+        contents + profile.suffix, generation_config=profile.generation_config(), **kwargs
+    )
+
+
+if app.config['BATCH_WINDOW_MS'] > 0:
+    generate_content = PromptBatcher(
+        call_model,
+        window=app.config['BATCH_WINDOW_MS'] / 1000,
+        max_batch=app.config['BATCH_MAX_SIZE'],
+        max_concurrency=app.config['BATCH_MAX_CONCURRENCY'],
+    )
+else:
+    generate_content = call_model
+
+
+def summarize(summary, turns):
+    transcript = "\n".join("{0}: {1}".format(sender, text) for sender, text in turns)
+    return generate_content(
+        "Update this summary of a chat with the new messages. Reply with the summary only, "
+        "in under 100 words.\n\nSummary: {0}\n\nNew messages:\n{1}".format(summary or "(empty)", transcript)
+    ).text
+
+
+conversation = ConversationContext(
+    summarize,
+    budget=app.config['CONTEXT_TOKENS'],
+    summary_tokens=app.config['CONTEXT_SUMMARY_TOKENS'],
+)
+
+
+def drop_room(room):
+    rooms.delete(room)
+    room_codes.release(room)
+    conversation.forget(room)
+    broadcaster.forget(room)
+    reaper.forget(room)
+
+
+def close_room(room, notice):
+    # asgi.py replaces this, since its clients are connected to its own Socket.IO server.
+    # Sent directly rather than published, so it goes out before the room is closed.
+    broadcaster.direct(room, NOTICE, notice)
+    socketio.close_room(room)
+
+
+def expire_room(room, reason):
+    drop_room(room)
+    close_room(room, "This room has expired. Leave the chat to start a new one.")
+    delete_connection('Room expired ({0}): {1}'.format(reason, room), room=room, reason=reason)
+
+
+def room_profile(room):
+    # Profiles live in the room store so every worker sees the same choice.
+    try:
+        return rooms.profile(room)
+    except KeyError:
+        return None
+
+
+def room_in_use(room):
+    # Member counts live in the room store, so rooms busy on another worker count too.
+    try:
+        return rooms.members(room) > 0
+    except KeyError:
+        return False
+
+
+reaper = RoomReaper(
+    expire_room,
+    idle_ttl=app.config['ROOM_IDLE_TTL'],
+    unjoined_ttl=app.config['ROOM_UNJOINED_TTL'],
+    interval=app.config['REAPER_INTERVAL'],
+    in_use=room_in_use,
+)
+# Rooms that outlived a restart in a shared store start a fresh idle clock.
+for code in rooms.codes():
+    reaper.touch(code)
+reaper.start()
+
+
+# Upper bounds for aibot_rooms_by_members. Room codes are never used as labels: /metrics is
+# unauthenticated and they are what lets someone join a room.
+ROOM_MEMBER_BUCKETS = (0, 1, 2, 5, 10, 25, 50)
+
+
+def rooms_by_members():
+    counts = rooms.member_counts()
+    buckets = {(str(bound),): sum(count <= bound for count in counts) for bound in ROOM_MEMBER_BUCKETS}
+    buckets[('+Inf',)] = len(counts)
+    return buckets
+
+
+def stat_gauge(stats):
+    return lambda: {(key,): value for key, value in stats().items()}
+
+
+metrics = MetricsRegistry()
+model_latency = metrics.histogram('aibot_model_call_seconds', 'Time spent in generate_content calls.')
+message_latency = metrics.histogram('aibot_handle_message_seconds', 'Time from receiving a message to the reply being sent.')
+socket_events = metrics.counter('aibot_socketio_events_total', 'Socket.IO events handled.', ('event',))
+metrics.gauge('aibot_rooms', 'Open rooms.', lambda: len(rooms))
+metrics.gauge('aibot_room_members', 'Members connected across all rooms.', lambda: sum(rooms.member_counts()))
+metrics.gauge('aibot_rooms_by_members', 'Open rooms with at most `le` members connected.', rooms_by_members, ('le',))
+metrics.gauge('aibot_response_cache', 'Response cache statistics.', stat_gauge(response_cache.stats), ('stat',))
+# Looked up per scrape, since asgi.py swaps in its own pool.
+metrics.gauge('aibot_generation_pool', 'Generation queue statistics.', stat_gauge(lambda: generation_pool.stats()), ('stat',))
+metrics.gauge('aibot_room_codes', 'Room code allocator statistics.', stat_gauge(room_codes.stats), ('stat',))
+metrics.gauge('aibot_broadcast', 'Room broadcast frame and batch counts.', stat_gauge(broadcaster.stats), ('stat',))
+metrics.gauge('aibot_reaper', 'Idle room reaper statistics.', stat_gauge(reaper.stats), ('stat',))
+metrics.gauge('aibot_profile_selector', 'Latency-driven profile step-down level and switch count.', stat_gauge(profile_selector.stats), ('stat',))
+metrics.gauge('aibot_in_flight_prompts', 'Unique prompts currently being generated.', single_flight.in_flight)
+if isinstance(generate_content, PromptBatcher):
+    metrics.gauge('aibot_batcher', 'Prompt batcher statistics.', stat_gauge(generate_content.stats), ('stat',))
+
+REPLY_ERROR = "Sorry, I couldn't answer that. Please try again."
+
+
+def model_notice():
+    # Every reply blocks on the model, so messages sent while it loads are turned away
+    # instead of parking a worker (or, under asgi.py, the event loop) on it.
+    status = aiLib.status()
+    if status == 'loading':
+        return "AIBot is still starting up, please try again in a moment."
+    if status == 'failed':
+        return REPLY_ERROR
+    return None
+
+
+@contextmanager
+def timed_model_call():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        model_latency.observe(elapsed)
+        profile_selector.observe(elapsed)
 
-rooms = {}
 
 @app.route('/v1', methods=['GET', 'POST'])
 def api():
     if request.method == 'GET':
         return redirect(url_for('home'))
     if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return {'error': 'Expected a JSON object'}, 400
+        if 'op' not in body:
+            if app.config['ADMIN_TOKEN'] and not admin_authorized():
+                return {'error': 'Unauthorized'}, 401
+            try:
+                room=body["room"]
+                if not isinstance(room, str) or room not in rooms: raise KeyError(room)
+                drop_room(room)
+                close_room(room, "This room was closed by an administrator.")
+                return {'deleted': room}
+            except KeyError: return {'error': 'Room not found'}
+
+        if not admin_authorized():
+            return {'error': 'Unauthorized'}, 401
+        op = body['op']
+        if op == 'create':
+            count = body.get('count', 1)
+            if not isinstance(count, int) or not 0 < count <= app.config['ADMIN_MAX_BATCH']:
+                return {'error': 'count must be between 1 and {0}'.format(app.config['ADMIN_MAX_BATCH'])}, 400
+            lines = admin_create(count)
+        elif op == 'stat' and 'rooms' not in body:
+            lines = admin_stat(rooms.codes())
+        elif op in ('delete', 'stat', 'profile'):
+            codes = body.get('rooms')
+            if (
+                not isinstance(codes, list)
+                or len(codes) > app.config['ADMIN_MAX_BATCH']
+                or not all(isinstance(code, str) for code in codes)
+            ):
+                return {'error': 'rooms must be a list of at most {0} codes'.format(app.config['ADMIN_MAX_BATCH'])}, 400
+            if op == 'profile':
+                name = body.get('profile')
+                if name is not None and name not in profile_selector.by_name:
+                    return {'error': 'Unknown profile: {0}'.format(name)}, 400
+                lines = admin_profile(codes, name)
+            else:
+                lines = admin_delete(codes) if op == 'delete' else admin_stat(codes)
+        else:
+            return {'error': 'Unknown op: {0}'.format(op)}, 400
+        # One JSON object per line, produced as we go, so large batches never build one big body.
+        return Response((json.dumps(line) + '\n' for line in lines), mimetype='application/x-ndjson')
+
+
+def admin_authorized():
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        return False
+    scheme, _, supplied = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and secrets.compare_digest(supplied.strip().encode(), token.encode())
+
+
+def admin_create(count):
+    for _ in range(count):
+        code = room_codes.allocate()
+        rooms.create(code)
+        reaper.created(code)
+        yield {'room': code}
+
+
+def admin_delete(codes):
+    for code in codes:
+        deleted = code in rooms
+        if deleted:
+            drop_room(code)
+            close_room(code, "This room was closed by an administrator.")
+        yield {'room': code, 'deleted': deleted}
+
+
+def admin_stat(codes):
+    for code in codes:
         try:
-            room=request.json["room"]
-            rooms.pop(room)
-        except KeyError: return {'error': 'Room not found'}
+            yield {'room': code, **rooms.stat(code), 'profile': rooms.profile(code) or profiles[0].name}
+        except KeyError:
+            yield {'room': code, 'error': 'Room not found'}
 
 
+def admin_profile(codes, name):
+    # A null profile puts the room back on the default.
+    for code in codes:
+        if code not in rooms:
+            yield {'room': code, 'error': 'Room not found'}
+            continue
+        try:
+            rooms.set_profile(code, name)
+        except KeyError:
+            yield {'room': code, 'error': 'Room not found'}
+            continue
+        yield {'room': code, 'profile': name or profiles[0].name}
+
+
+@app.route('/ready')
+def ready():
+    # 503 until the model has loaded, so load balancers hold traffic while we warm up.
+    status = aiLib.status()
+    body = {
+        'status': status,
+        'startup_seconds': {name: round(seconds, 3) for name, seconds in IMPORT_PROFILE.items()},
+    }
+    return body, 200 if status == 'ready' else 503
+
+
+@app.route('/v1/stats')
+def api_stats():
+    pool = generation_pool.stats()
+    return {
+        **rooms.totals(),
+        'generations_running': pool['running'],
+        'generations_queued': pool['queued'],
+        'in_flight_prompts': single_flight.in_flight(),
+        'generation_profile': profile_selector.select().name,
+    }
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 @app.route('/', methods=["GET", "POST"])
 def home():
@@ -40,12 +403,9 @@ def home():
             return render_template('home.html', error="You cant have that name.")
         
         if create != False:
-            room_code = generate_room_code(6, list(rooms.keys()))
-            new_room = {
-                'members': 0,
-                'messages': []
-            }
-            rooms[room_code] = new_room
+            room_code = room_codes.allocate()
+            rooms.create(room_code)
+            reaper.created(room_code)
 
         session['room'] = room_code
         session['name'] = name
@@ -62,14 +422,29 @@ def room():
     if name is None or room is None or room not in rooms:
         return redirect(url_for('home'))
 
-    messages = rooms[room]['messages']
-    return render_template('room.html', room=room, user=name, messages=messages)
+    return render_template('room.html', room=room, user=name, msgpack=broadcaster.use_msgpack)
+
+
+@app.route('/room/history')
+def room_history():
+    room = session.get('room')
+    if session.get('name') is None or room is None or room not in rooms:
+        return {'error': 'Room not found'}, 404
+
+    limit = min(request.args.get('limit', app.config['HISTORY_PAGE_SIZE'], type=int), 200)
+    before = request.args.get('before', type=int)
+    try:
+        messages, cursor = rooms.history(room, before, max(limit, 1))
+    except KeyError:
+        return {'error': 'Room not found'}, 404
+    return jsonify(messages=messages, cursor=cursor)
 
 
 @socketio.on('connect')
 def handle_connect():
     name = session.get('name')
     room = session.get('room')
+    socket_events.inc('connect')
     if name is None or room is None:
         return
     if room not in rooms:
@@ -77,19 +452,20 @@ def handle_connect():
     
     try:
         join_room(room)
-        send({
-            "sender": "",
-            "message": f"Welcome! The bot may take some time to generate a response depending on the length of the prompt."
-        }, to=room)
-        rooms[room]["members"] += 1
-        new_connection("New Connection established. Room: {0}".format(room))
-        info("Rooms: {0}".format(rooms.keys()))
+        rooms.add_member(room)
+        # Only rooms that exist are opened, so nothing is kept for a stale session's room.
+        broadcaster.join(room, request.sid)
+        broadcaster.publish(room, NOTICE, "Welcome! The bot may take some time to generate a response depending on the length of the prompt.")
+        reaper.touch(room)
+        new_connection("New Connection established. Room: {0}".format(room), room=room)
     except KeyError:
         return redirect(url_for("home"))
 
 
 @socketio.on('message')
 def handle_message(payload):
+    started = time.perf_counter()
+    socket_events.inc('message')
     room = session.get('room')
     name = session.get('name')
 
@@ -100,30 +476,170 @@ def handle_message(payload):
         "sender": name,
         "message": payload["message"]
     }
-    send(message, to=room)
-    send({
-        "sender": "",
-        "message": "AIBot is thinking"
-    }, to = room)
-    send({
-        "sender": "AIBot",
-        "message":aiLib.generate_content(str(payload['message'])+' in about 60 words.').text
-    }, to = room)
-    rooms[room]["messages"].append(message)
+    broadcaster.publish(room, MSG, message["message"], sender=name)
+    rooms.append_message(room, message)
+    reaper.touch(room)
+    notice = model_notice()
+    if notice is not None:
+        broadcaster.direct(request.sid, NOTICE, notice)
+        return
+    prompt = str(payload['message'])
+    try:
+        # The queue position updates replace the old "AIBot is thinking" notice.
+        generation_pool.submit(room, lambda: generate_reply(room, prompt, started), ticket=next(event_ids))
+    except Busy:
+        broadcaster.direct(request.sid, NOTICE, "AIBot is busy right now, please try again in a moment.")
+
+
+def generate_reply(room, prompt, started):
+    # Runs on a pool thread, so emit through the server rather than the request context.
+    def finished(text):
+        record_reply(room, prompt, text)
+        message_latency.observe(time.perf_counter() - started)
+
+    reply(room, prompt, finished)
+
+
+# The helpers from here to emit_reply are shared with asgi.py, which drives them with coroutines.
+def plan_reply(room, prompt):
+    """Returns the profile, the text to send the model and its cache key (None if it can't be shared)."""
+    # Picked per reply, so a room falls back to a faster profile as soon as latency calls for it.
+    profile = profile_selector.select(room_profile(room))
+    context = conversation.build(room) if app.config['CONTEXT_TOKENS'] > 0 else ''
+    if context:
+        # Follow-ups depend on the room's history, so they can't share cached answers.
+        return profile, context + "\nUser: " + prompt, None
+    return profile, prompt, reply_cache_key(prompt, profile)
+
+
+def record_reply(room, prompt, text):
+    if text is None or app.config['CONTEXT_TOKENS'] <= 0:
+        return
+    conversation.record(room, "User", prompt)
+    conversation.record(room, "AIBot", text)
+    # Checked after recording, so a room dropped mid-reply is forgotten again whichever ran first.
+    if room not in rooms:
+        conversation.forget(room)
+
+
+def reply_cache_key(prompt, profile):
+    model = profile.model or getattr(aiLib, 'model_name', '')
+    return response_cache.key(prompt, profile.suffix, model=model, **profile.generation_config())
+
+
+def shared_reply(room, future, emit):
+    # The leader's produce_reply already sent its own reply unless it raised.
+    e = future.exception()
+    if e is not None:
+        return reply_failed(room, e)
+    text = future.result()
+    if emit:
+        emit_reply(room, REPLY_ERROR if text is None else text)
+    return text
+
+
+def reply_failed(room, e):
+    error("Generation failed in room {0}: {1!r}".format(room, e))
+    emit_reply(room, REPLY_ERROR)
+    return None
+
+
+class ReplyStream:
+    """Publishes one streamed reply to a room as CHUNK frames."""
+
+    def __init__(self, room):
+        self.room = room
+        self.id = next(event_ids)
+        self.parts = []
+
+    def add(self, text):
+        if text:
+            broadcaster.publish(self.room, CHUNK, [self.id, len(self.parts), text, 0])
+            self.parts.append(text)
+
+    def finish(self):
+        broadcaster.publish(self.room, CHUNK, [self.id, len(self.parts), "", 1])
+        return "".join(self.parts)
+
+    def fail(self, e):
+        error("Generation failed in room {0}: {1!r}".format(self.room, e))
+        broadcaster.publish(self.room, CHUNK, [self.id, len(self.parts), REPLY_ERROR, 1])
+        return None
+
+
+def emit_reply(room, text):
+    if app.config['STREAM_REPLIES']:
+        broadcaster.publish(room, CHUNK, [next(event_ids), 0, text, 1])
+    else:
+        broadcaster.publish(room, MSG, text, sender="AIBot")
+
+
+def reply(room, prompt, finished):
+    profile, contents, key = plan_reply(room, prompt)
+    if key is None:
+        finished(produce_reply(room, None, contents, profile))
+        return
+    text = response_cache.get(key)
+    if text is not None:
+        emit_reply(room, text)
+        finished(text)
+        return
+
+    # Rooms asking the same question while it is being answered get that answer. They don't
+    # wait for it on a pool worker: the leader's thread sends their reply when it completes.
+    future, leader = single_flight.do(key, lambda: produce_reply(room, key, contents, profile))
+    if leader:
+        finished(shared_reply(room, future, emit=False))
+    else:
+        future.add_done_callback(lambda future: finished(shared_reply(room, future, emit=True)))
+
+
+def produce_reply(room, key, contents, profile):
+    if app.config['STREAM_REPLIES']:
+        text = stream_reply(room, contents, profile)
+    else:
+        text = complete_reply(room, contents, profile)
+    if text is not None and key is not None:
+        # Cached before the in-flight entry is dropped so late arrivals hit the cache.
+        response_cache.set(key, text)
+    return text
+
+
+def complete_reply(room, contents, profile):
+    try:
+        with timed_model_call():
+            text = generate_content(contents, profile).text
+    except Exception as e:
+        return reply_failed(room, e)
+    emit_reply(room, text)
+    return text
+
+
+def stream_reply(room, contents, profile):
+    stream = ReplyStream(room)
+    try:
+        with timed_model_call():
+            for chunk in generate_content(contents, profile, stream=True):
+                stream.add(chunk.text)
+    except Exception as e:
+        return stream.fail(e)
+    return stream.finish()
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    socket_events.inc('disconnect')
     room = session.get("room")
     name = session.get("name")
     leave_room(room)
 
-    if room in rooms:
-        rooms[room]["members"] -= 1
-        if rooms[room]["members"] <= 0:
-            del rooms[room]
-            delete_connection('Room deletion: {0}'.format(room))
-            info("Rooms: {0}".format(rooms.keys()))
+    try:
+        members = rooms.add_member(room, -1)
+    except KeyError:
+        return
+    if members <= 0:
+        drop_room(room)
+        delete_connection('Room deletion: {0}'.format(room), room=room)
 
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', debug=True)
+    socketio.run(app, host='0.0.0.0', debug=os.environ.get('FLASK_DEBUG', '1') == '1')
@@ -0,0 +1,1703 @@
+"""Serving helpers for the chat server.
+
+Logging, room broadcasting, metrics, room state, generation scheduling,
+caching and generation profiles. Unlike utils.py nothing here touches the AI
+library, so this module imports (and can be tested) on its own.
+"""
+from __future__ import annotations
+
+import asyncio
+import atexit
+import dataclasses
+import heapq
+import json
+import os
+import queue
+import random
+import secrets
+import sqlite3
+import string
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from string import ascii_letters
+from typing import Any, Awaitable, Callable, Sequence
+
+
+#Room codes
+class RoomCodeAllocator:
+    """Hands out unique room codes in O(1) expected time.
+
+    Live codes are tracked in a set, and each candidate is drawn from
+    `secrets` with a single call. When more than `max_load` of the code
+    space is in use, codes grow by one character so collisions stay rare.
+    `taken` can check a shared store for codes allocated by other processes.
+    """
+
+    def __init__(
+        self,
+        length: int = 6,
+        alphabet: str = ascii_letters,
+        max_load: float = 0.01,
+        taken: Callable[[str], bool] | None = None,
+    ):
+        self.length = length
+        self.alphabet = alphabet
+        self.max_load = max_load
+        self.taken = taken
+        self.live: set[str] = set()
+        self.lock = threading.Lock()
+        self.allocations = 0
+        self.collisions = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.alphabet) ** self.length
+
+    def allocate(self) -> str:
+        base = len(self.alphabet)
+        with self.lock:
+            while True:
+                n = secrets.randbelow(self.capacity)
+                chars = []
+                for _ in range(self.length):
+                    n, i = divmod(n, base)
+                    chars.append(self.alphabet[i])
+                code = ''.join(chars)
+                if code not in self.live and not (self.taken and self.taken(code)):
+                    break
+                self.collisions += 1
+
+            self.live.add(code)
+            self.allocations += 1
+            if len(self.live) > self.max_load * self.capacity:
+                self.length += 1
+            return code
+
+    def reserve(self, codes) -> None:
+        """Marks codes that already exist (e.g. loaded from a room store) as live."""
+        with self.lock:
+            self.live.update(codes)
+
+    def release(self, code: str) -> None:
+        with self.lock:
+            self.live.discard(code)
+
+    def stats(self) -> dict[str, float]:
+        with self.lock:
+            attempts = self.allocations + self.collisions
+            return {
+                'live': len(self.live),
+                'length': self.length,
+                'capacity': self.capacity,
+                'allocations': self.allocations,
+                'collisions': self.collisions,
+                'collision_rate': self.collisions / attempts if attempts else 0.0,
+            }
+
+#Logging
+class EventLog:
+    """Queue-backed logger that formats and writes on a background thread.
+
+    Callers only filter by level, apply sampling and enqueue, so logging
+    stays off the request path. The writer drains the queue in batches and
+    writes one JSON object per line, or colored text when `color` is true
+    (the default when the stream is a TTY). `sample_rates` maps event names
+    to the fraction of those events to keep.
+    """
+
+    LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+    COLORS = {'connect': 'GREEN', 'disconnect': 'RED', 'warning': 'YELLOW', 'error': 'RED'}
+
+    def __init__(
+        self,
+        stream=None,
+        level: str = 'info',
+        sample_rates: dict[str, float] | None = None,
+        color: bool | None = None,
+        batch_size: int = 256,
+        max_queued: int = 10000,
+    ):
+        self.stream = sys.stdout if stream is None else stream
+        level = level.strip().lower()
+        if level not in self.LEVELS:
+            raise ValueError('Unknown log level {0!r}; expected one of {1}'.format(level, ', '.join(self.LEVELS)))
+        self.level = self.LEVELS[level]
+        self.sample_rates = sample_rates or {}
+        isatty = getattr(self.stream, 'isatty', None)
+        self.color = bool(isatty and isatty()) if color is None else color
+        if self.color:
+            # colorama is only needed for terminal output, so JSON logging never imports it.
+            import colorama
+
+            colorama.init(autoreset=True)
+            self.colorama = colorama
+        self.batch_size = batch_size
+        self.queue: queue.Queue = queue.Queue(max_queued)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._write_loop, name='aibot-log', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def log(self, level: str, event: str, message: str, **fields) -> None:
+        if self.LEVELS[level] < self.level:
+            return
+        rate = self.sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, event, message, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        self.queue.join()
+
+    def _format(self, record) -> str:
+        created, level, event, message, fields = record
+        if self.color:
+            Fore, Style = self.colorama.Fore, self.colorama.Style
+            color = getattr(Fore, self.COLORS.get(event, 'BLUE'))
+            return '{0}{1}[{2}]: {3}{4}{5}'.format(
+                color, Style.BRIGHT, event.upper(), Style.RESET_ALL, Style.BRIGHT + message, Style.RESET_ALL
+            )
+        return json.dumps({'ts': created, 'level': level, 'event': event, 'message': message, **fields}, default=str)
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.stream.write(''.join(self._format(record) + '\n' for record in batch))
+                self.stream.flush()
+            except Exception:
+                pass
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def _sample_rates(spec: str) -> dict[str, float]:
+    rates = {}
+    for item in filter(None, spec.split(',')):
+        event, _, rate = item.partition('=')
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+log = EventLog(
+    level=os.environ.get('LOG_LEVEL', 'info'),
+    sample_rates=_sample_rates(os.environ.get('LOG_SAMPLE', '')),
+)
+
+
+def new_connection(txt:str, **fields):
+    log.log('info', 'connect', txt, **fields)
+def delete_connection(txt:str, **fields):
+    log.log('info', 'disconnect', txt, **fields)
+def info(txt:str, **fields):
+    log.log('info', 'info', txt, **fields)
+def warning(txt:str, **fields):
+    log.log('warning', 'warning', txt, **fields)
+def error(txt:str, **fields):
+    log.log('error', 'error', txt, **fields)
+
+
+#Broadcasting
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Frame types of the compact room protocol. Every frame is [type, seq, sender_id, payload].
+MSG, NOTICE, QUEUE, CHUNK, SENDER = range(5)
+
+
+class RoomBroadcaster:
+    """Encodes room events as compact frames and coalesces them per room.
+
+    Senders are interned to small per-room ids: the first frame from a new
+    sender is preceded by a SENDER frame mapping its id to its name. Frames
+    carry a per-room sequence number. Frames published within one `tick` are
+    sent as a single `emit(room, data)` call; a tick of 0 sends immediately.
+    With `use_msgpack` (and msgpack installed) each batch is encoded as
+    MessagePack bytes instead of a JSON list.
+
+    A room is open from the first `join` until `forget`. Publishes to rooms
+    that aren't open are dropped, so a reply that finishes after its room was
+    closed can't bring the room's state back.
+
+    Sender tables are kept per process, so a client joining through one
+    worker can't learn the ids another worker handed out. When several
+    workers share rooms, pass `intern_senders=False` and frames carry the
+    sender's name in place of its id.
+    """
+
+    def __init__(
+        self,
+        emit: Callable[[str, Any], None],
+        tick: float = 0.01,
+        use_msgpack: bool = False,
+        intern_senders: bool = True,
+    ):
+        self.emit = emit
+        self.tick = tick
+        self.use_msgpack = use_msgpack and msgpack is not None
+        self.intern_senders = intern_senders
+        self.lock = threading.Lock()
+        self.buffers: dict[str, list[list]] = {}
+        self.seqs: dict[str, int] = {}
+        self.senders: dict[str, dict[str, int]] = {}
+        self.frames = 0
+        self.batches = 0
+        self.flusher: threading.Thread | None = None
+
+    def publish(self, room: str, kind: int, payload: Any, sender: str | None = None) -> None:
+        with self.lock:
+            if room not in self.seqs:
+                return
+            if self.tick > 0 and self.flusher is None:
+                # Started on first use, so a broadcaster that never publishes costs no thread.
+                self.flusher = threading.Thread(target=self._flush_loop, name='aibot-broadcast', daemon=True)
+                self.flusher.start()
+            frames = self.buffers.setdefault(room, [])
+            sender_id = 0
+            if sender is not None and not self.intern_senders:
+                sender_id = sender
+            elif sender is not None:
+                table = self.senders.setdefault(room, {})
+                sender_id = table.get(sender)
+                if sender_id is None:
+                    sender_id = table[sender] = len(table) + 1
+                    frames.append(self._frame(room, SENDER, sender_id, sender))
+            frames.append(self._frame(room, kind, sender_id, payload))
+            if self.tick <= 0:
+                # Emitting under the lock keeps frames in order without a flush thread.
+                self._send(room, self.buffers.pop(room))
+
+    def direct(self, target: str, kind: int, payload: Any) -> None:
+        """Sends one frame to a single client, outside any room's sequence."""
+        self._send(target, [[kind, -1, 0, payload]])
+
+    def join(self, room: str, target: str) -> None:
+        """Opens the room if needed and sends its sender table to a client that just joined."""
+        with self.lock:
+            self.seqs.setdefault(room, 0)
+            frames = [[SENDER, -1, sender_id, name] for name, sender_id in self.senders.get(room, {}).items()]
+        if frames:
+            self._send(target, frames)
+
+    def forget(self, room: str) -> None:
+        with self.lock:
+            self.seqs.pop(room, None)
+            self.senders.pop(room, None)
+            self.buffers.pop(room, None)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {'frames': self.frames, 'batches': self.batches}
+
+    def _frame(self, room: str, kind: int, sender_id: int, payload: Any) -> list:
+        seq = self.seqs[room]
+        self.seqs[room] = seq + 1
+        return [kind, seq, sender_id, payload]
+
+    def _send(self, target: str, frames: list[list]) -> None:
+        self.frames += len(frames)
+        self.batches += 1
+        try:
+            self.emit(target, msgpack.packb(frames) if self.use_msgpack else frames)
+        except Exception as e:
+            error('Broadcast to {0} failed: {1!r}'.format(target, e))
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.tick)
+            with self.lock:
+                buffers, self.buffers = self.buffers, {}
+            for room, frames in buffers.items():
+                self._send(room, frames)
+
+
+#Metrics
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            yield self.name + '_bucket', {'le': '+Inf' if bound == float('inf') else repr(bound)}, cumulative
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, cumulative
+
+
+class Gauge:
+    """A gauge whose value is read from `fn` at scrape time.
+
+    `fn` returns either a number or, for labelled gauges, a dict mapping
+    label-value tuples to numbers.
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            yield self.name, {}, value
+            return
+        for labels, sample in value.items():
+            yield self.name, dict(zip(self.labelnames, labels)), sample
+
+
+class MetricsRegistry:
+    """Holds the server's metrics and renders them in the Prometheus text format.
+
+    Recording only takes the metric's own uncontended lock, so it is cheap
+    enough for the Socket.IO handlers; all formatting happens at scrape time.
+    """
+
+    def __init__(self):
+        self.metrics: list[tuple[str, Any]] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(('counter', metric))
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(('histogram', metric))
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()) -> Gauge:
+        metric = Gauge(name, help, fn, labelnames)
+        self.metrics.append(('gauge', metric))
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for kind, metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, kind))
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ','.join('{0}="{1}"'.format(k, _escape_label(v)) for k, v in labels.items())
+                    lines.append('{0}{{{1}}} {2}'.format(name, label_text, float(value)))
+                else:
+                    lines.append('{0} {1}'.format(name, float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+#Room state
+class RoomHistory:
+    """Fixed-capacity message history for one room.
+
+    Messages are numbered with a monotonically increasing sequence number that
+    doubles as a cursor. Appends are O(1) and evict the oldest messages once
+    either `max_messages` or `max_bytes` is exceeded; reads walk from the
+    newest end, so rendering the tail never touches older messages.
+    """
+
+    def __init__(self, max_messages: int = 500, max_bytes: int = 256 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.items: deque[tuple[int, dict, int]] = deque()
+        self.size = 0
+        self.next_seq = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    @property
+    def first_seq(self) -> int:
+        return self.next_seq - len(self.items)
+
+    def append(self, message: dict) -> int:
+        size = len(message.get('sender') or '') + len(message.get('message') or '')
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.items.append((seq, message, size))
+            self.size += size
+            while len(self.items) > self.max_messages or (self.size > self.max_bytes and len(self.items) > 1):
+                self.size -= self.items.popleft()[2]
+        return seq
+
+    def before(self, cursor: int | None, limit: int) -> tuple[list[dict], int | None]:
+        """Returns up to `limit` messages older than `cursor` and the cursor of the next older page."""
+        with self.lock:
+            end = self.next_seq if cursor is None else min(cursor, self.next_seq)
+            start = max(end - limit, self.first_seq)
+            if start >= end:
+                return [], None
+            skip = self.next_seq - end
+            page = list(islice(reversed(self.items), skip, skip + end - start))
+            return [message for _, message, _ in reversed(page)], (start if start > self.first_seq else None)
+
+
+class RoomStore:
+    """Interface for room state shared by the Flask routes and Socket.IO handlers.
+
+    `members` and `add_member` raise `KeyError` for unknown rooms, matching the
+    behaviour of the plain dict this replaces.
+    """
+
+    def create(self, code: str) -> None:
+        raise NotImplementedError
+
+    def __contains__(self, code: str) -> bool:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        return len(self.codes())
+
+    def codes(self) -> list[str]:
+        raise NotImplementedError
+
+    def members(self, code: str) -> int:
+        raise NotImplementedError
+
+    def add_member(self, code: str, delta: int = 1) -> int:
+        """Adjusts the member count of a room and returns the new count."""
+        raise NotImplementedError
+
+    def append_message(self, code: str, message: dict) -> int:
+        """Appends to the room's history and returns the message's sequence number."""
+        raise NotImplementedError
+
+    def history(self, code: str, before: int | None = None, limit: int = 50) -> tuple[list[dict], int | None]:
+        """Returns up to `limit` messages older than the `before` cursor, oldest first.
+
+        With no cursor the newest messages are returned. The second value is the
+        cursor for the next older page, or None when there is nothing older.
+        """
+        raise NotImplementedError
+
+    def profile(self, code: str) -> str | None:
+        """Returns the generation profile chosen for a room, or None for the default."""
+        raise NotImplementedError
+
+    def set_profile(self, code: str, name: str | None) -> None:
+        """Sets or (with None) clears a room's generation profile."""
+        raise NotImplementedError
+
+    def delete(self, code: str) -> bool:
+        """Deletes a room, returning whether it existed."""
+        raise NotImplementedError
+
+    def stat(self, code: str) -> dict[str, int]:
+        """Returns a room's member count, retained message count and history size in bytes."""
+        raise NotImplementedError
+
+    def member_counts(self) -> list[int]:
+        """Returns the member count of every room, in no particular order."""
+        counts = []
+        for code in self.codes():
+            try:
+                counts.append(self.members(code))
+            except KeyError:
+                pass
+        return counts
+
+    def totals(self) -> dict[str, int]:
+        """Returns room, member and history-byte totals across the store."""
+        totals = {'rooms': 0, 'members': 0, 'history_bytes': 0}
+        for code in self.codes():
+            try:
+                stat = self.stat(code)
+            except KeyError:
+                continue
+            totals['rooms'] += 1
+            totals['members'] += stat['members']
+            totals['history_bytes'] += stat['bytes']
+        return totals
+
+
+class MemoryRoomStore(RoomStore):
+    """Keeps rooms in a dict owned by this process."""
+
+    def __init__(self, max_messages: int = 500, max_bytes: int = 256 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.rooms: dict[str, dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def create(self, code: str) -> None:
+        self.rooms[code] = {
+            'members': 0,
+            'messages': RoomHistory(self.max_messages, self.max_bytes),
+            'profile': None,
+        }
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.rooms
+
+    def __len__(self) -> int:
+        return len(self.rooms)
+
+    def codes(self) -> list[str]:
+        return list(self.rooms)
+
+    def members(self, code: str) -> int:
+        return self.rooms[code]['members']
+
+    def add_member(self, code: str, delta: int = 1) -> int:
+        with self.lock:
+            room = self.rooms[code]
+            room['members'] += delta
+            return room['members']
+
+    def append_message(self, code: str, message: dict) -> int:
+        return self.rooms[code]['messages'].append(message)
+
+    def history(self, code: str, before: int | None = None, limit: int = 50) -> tuple[list[dict], int | None]:
+        return self.rooms[code]['messages'].before(before, limit)
+
+    def profile(self, code: str) -> str | None:
+        return self.rooms[code]['profile']
+
+    def set_profile(self, code: str, name: str | None) -> None:
+        self.rooms[code]['profile'] = name
+
+    def delete(self, code: str) -> bool:
+        return self.rooms.pop(code, None) is not None
+
+    def stat(self, code: str) -> dict[str, int]:
+        room = self.rooms[code]
+        return {'members': room['members'], 'messages': len(room['messages']), 'bytes': room['messages'].size}
+
+    def member_counts(self) -> list[int]:
+        return [room['members'] for room in list(self.rooms.values())]
+
+
+class SQLiteRoomStore(RoomStore):
+    """Keeps rooms in an SQLite database in WAL mode.
+
+    WAL lets readers in every worker process proceed while one of them writes,
+    so several server processes on one host can share the same file.
+    """
+
+    def __init__(self, path: str, max_messages: int = 500, max_bytes: int = 256 * 1024):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        with self.connection() as db:
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS rooms (
+                    code TEXT PRIMARY KEY,
+                    members INTEGER NOT NULL DEFAULT 0,
+                    next_seq INTEGER NOT NULL DEFAULT 0,
+                    profile TEXT
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    room TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    sender TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    PRIMARY KEY (room, seq)
+                );
+                """
+            )
+            columns = [name for _, name, *_ in db.execute('PRAGMA table_info(rooms)')]
+            if 'profile' not in columns:
+                # Databases created before room profiles existed.
+                db.execute('ALTER TABLE rooms ADD COLUMN profile TEXT')
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, so keep one per thread.
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def create(self, code: str) -> None:
+        with self.connection() as db:
+            db.execute('INSERT OR REPLACE INTO rooms (code) VALUES (?)', (code,))
+            db.execute('DELETE FROM messages WHERE room = ?', (code,))
+
+    def __contains__(self, code: str) -> bool:
+        row = self.connection().execute('SELECT 1 FROM rooms WHERE code = ?', (code,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self.connection().execute('SELECT COUNT(*) FROM rooms').fetchone()[0]
+
+    def codes(self) -> list[str]:
+        return [code for code, in self.connection().execute('SELECT code FROM rooms')]
+
+    def members(self, code: str) -> int:
+        row = self.connection().execute('SELECT members FROM rooms WHERE code = ?', (code,)).fetchone()
+        if row is None:
+            raise KeyError(code)
+        return row[0]
+
+    def add_member(self, code: str, delta: int = 1) -> int:
+        with self.connection() as db:
+            row = db.execute(
+                'UPDATE rooms SET members = members + ? WHERE code = ? RETURNING members', (delta, code)
+            ).fetchone()
+        if row is None:
+            raise KeyError(code)
+        return row[0]
+
+    def append_message(self, code: str, message: dict) -> int:
+        with self.connection() as db:
+            row = db.execute(
+                'UPDATE rooms SET next_seq = next_seq + 1 WHERE code = ? RETURNING next_seq', (code,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(code)
+            seq = row[0] - 1
+            db.execute(
+                'INSERT INTO messages (room, seq, sender, message) VALUES (?, ?, ?, ?)',
+                (code, seq, message['sender'], message['message']),
+            )
+            db.execute('DELETE FROM messages WHERE room = ? AND seq <= ?', (code, seq - self.max_messages))
+            # Keep the newest messages that fit in max_bytes, and always the one just added.
+            db.execute(
+                """
+                DELETE FROM messages WHERE room = ? AND seq < (
+                    SELECT COALESCE(MIN(seq), ?) FROM (
+                        SELECT seq, SUM(LENGTH(sender) + LENGTH(message)) OVER (ORDER BY seq DESC) AS total
+                        FROM messages WHERE room = ?
+                    ) WHERE total <= ?
+                )
+                """,
+                (code, seq, code, self.max_bytes),
+            )
+        return seq
+
+    def history(self, code: str, before: int | None = None, limit: int = 50) -> tuple[list[dict], int | None]:
+        # One extra row tells us whether an older page exists.
+        rows = self.connection().execute(
+            'SELECT seq, sender, message FROM messages WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+            (code, 2 ** 62 if before is None else before, limit + 1),
+        ).fetchall()
+        cursor = rows[limit - 1][0] if len(rows) > limit else None
+        rows = rows[:limit]
+        return [{'sender': sender, 'message': message} for _, sender, message in reversed(rows)], cursor
+
+    def profile(self, code: str) -> str | None:
+        row = self.connection().execute('SELECT profile FROM rooms WHERE code = ?', (code,)).fetchone()
+        if row is None:
+            raise KeyError(code)
+        return row[0]
+
+    def set_profile(self, code: str, name: str | None) -> None:
+        with self.connection() as db:
+            updated = db.execute('UPDATE rooms SET profile = ? WHERE code = ?', (name, code)).rowcount
+        if not updated:
+            raise KeyError(code)
+
+    def delete(self, code: str) -> bool:
+        with self.connection() as db:
+            deleted = db.execute('DELETE FROM rooms WHERE code = ?', (code,)).rowcount
+            db.execute('DELETE FROM messages WHERE room = ?', (code,))
+        return deleted > 0
+
+    def stat(self, code: str) -> dict[str, int]:
+        db = self.connection()
+        members = self.members(code)
+        count, size = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(sender) + LENGTH(message)), 0) FROM messages WHERE room = ?',
+            (code,),
+        ).fetchone()
+        return {'members': members, 'messages': count, 'bytes': size}
+
+    def member_counts(self) -> list[int]:
+        return [members for members, in self.connection().execute('SELECT members FROM rooms')]
+
+    def totals(self) -> dict[str, int]:
+        db = self.connection()
+        rooms, members = db.execute('SELECT COUNT(*), COALESCE(SUM(members), 0) FROM rooms').fetchone()
+        size = db.execute('SELECT COALESCE(SUM(LENGTH(sender) + LENGTH(message)), 0) FROM messages').fetchone()[0]
+        return {'rooms': rooms, 'members': members, 'history_bytes': size}
+
+
+class RedisRoomStore(RoomStore):
+    """Keeps rooms in Redis, or anything that speaks its protocol.
+
+    `client` is a `redis.Redis`-compatible client created with
+    `decode_responses=True`; `fakeredis.FakeRedis` (with `lupa` for scripting)
+    works as a local stand-in. Writes that check the room first run as Lua
+    scripts, so concurrent workers can't interleave them or race a delete.
+    """
+
+    # KEYS: rooms set, room hash. ARGV: code, delta. Returns nil for unknown rooms.
+    ADD_MEMBER = """
+    if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then return false end
+    return redis.call('HINCRBY', KEYS[2], 'members', ARGV[2])
+    """
+    # KEYS: rooms set, room hash, messages list. ARGV: code, message JSON, its size, max messages, max bytes.
+    # The sequence number is spliced into the JSON object so the list stays in seq order.
+    APPEND_MESSAGE = """
+    if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then return false end
+    local seq = redis.call('HINCRBY', KEYS[2], 'next_seq', 1) - 1
+    local length = redis.call('RPUSH', KEYS[3], '{"seq": ' .. seq .. ', ' .. string.sub(ARGV[2], 2))
+    local bytes = tonumber(redis.call('HGET', KEYS[2], 'bytes') or '0') + tonumber(ARGV[3])
+    local max_messages, max_bytes = tonumber(ARGV[4]), tonumber(ARGV[5])
+    while length > max_messages or (bytes > max_bytes and length > 1) do
+        local item = redis.call('LPOP', KEYS[3])
+        if not item then break end
+        bytes = bytes - (cjson.decode(item).size or 0)
+        length = length - 1
+    end
+    redis.call('HSET', KEYS[2], 'bytes', bytes)
+    return seq
+    """
+
+    # KEYS: rooms set, room hash. ARGV: code, profile name ('' clears it). Returns nil for unknown rooms.
+    SET_PROFILE = """
+    if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then return false end
+    if ARGV[2] == '' then return redis.call('HDEL', KEYS[2], 'profile') end
+    return redis.call('HSET', KEYS[2], 'profile', ARGV[2])
+    """
+    # KEYS: messages list. ARGV: before cursor (-1 for the newest page), limit.
+    # Returns up to limit + 1 items ending just before the cursor; the caller filters on seq.
+    HISTORY = """
+    local first = redis.call('LINDEX', KEYS[1], 0)
+    if not first then return {} end
+    local before, limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+    if before < 0 then return redis.call('LRANGE', KEYS[1], -(limit + 1), -1) end
+    local stop = math.min(before - cjson.decode(first).seq, redis.call('LLEN', KEYS[1])) - 1
+    if stop < 0 then return {} end
+    return redis.call('LRANGE', KEYS[1], math.max(stop - limit, 0), stop)
+    """
+
+    def __init__(self, client, prefix: str = 'aibot:', max_messages: int = 500, max_bytes: int = 256 * 1024):
+        self.client = client
+        self.prefix = prefix
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.add_member_script = client.register_script(self.ADD_MEMBER)
+        self.append_message_script = client.register_script(self.APPEND_MESSAGE)
+        self.history_script = client.register_script(self.HISTORY)
+        self.set_profile_script = client.register_script(self.SET_PROFILE)
+
+    def _room(self, code: str) -> str:
+        return '{0}room:{1}'.format(self.prefix, code)
+
+    def _messages(self, code: str) -> str:
+        return '{0}messages:{1}'.format(self.prefix, code)
+
+    def create(self, code: str) -> None:
+        pipe = self.client.pipeline()
+        pipe.delete(self._room(code), self._messages(code))
+        pipe.hset(self._room(code), mapping={'members': 0, 'next_seq': 0, 'bytes': 0})
+        pipe.sadd(self.prefix + 'rooms', code)
+        pipe.execute()
+
+    def __contains__(self, code: str) -> bool:
+        return bool(self.client.sismember(self.prefix + 'rooms', code))
+
+    def __len__(self) -> int:
+        return self.client.scard(self.prefix + 'rooms')
+
+    def codes(self) -> list[str]:
+        return list(self.client.smembers(self.prefix + 'rooms'))
+
+    def members(self, code: str) -> int:
+        members = self.client.hget(self._room(code), 'members')
+        if members is None:
+            raise KeyError(code)
+        return int(members)
+
+    def add_member(self, code: str, delta: int = 1) -> int:
+        members = self.add_member_script(keys=[self.prefix + 'rooms', self._room(code)], args=[code, delta])
+        if members is None:
+            raise KeyError(code)
+        return int(members)
+
+    def append_message(self, code: str, message: dict) -> int:
+        size = len(message['sender'] or '') + len(message['message'] or '')
+        # Each item carries its size so trimming can keep the room's byte count exact.
+        seq = self.append_message_script(
+            keys=[self.prefix + 'rooms', self._room(code), self._messages(code)],
+            args=[code, json.dumps({**message, 'size': size}), size, self.max_messages, self.max_bytes],
+        )
+        if seq is None:
+            raise KeyError(code)
+        return int(seq)
+
+    def history(self, code: str, before: int | None = None, limit: int = 50) -> tuple[list[dict], int | None]:
+        items = self.history_script(keys=[self._messages(code)], args=[-1 if before is None else before, limit])
+        items = [item for item in map(json.loads, items) if before is None or item['seq'] < before]
+        # One extra item tells us whether an older page exists.
+        cursor = items[-limit]['seq'] if len(items) > limit else None
+        messages = [{'sender': item['sender'], 'message': item['message']} for item in items[-limit:]]
+        return messages, cursor
+
+    def profile(self, code: str) -> str | None:
+        members, profile = self.client.hmget(self._room(code), 'members', 'profile')
+        if members is None:
+            raise KeyError(code)
+        return profile
+
+    def set_profile(self, code: str, name: str | None) -> None:
+        result = self.set_profile_script(keys=[self.prefix + 'rooms', self._room(code)], args=[code, name or ''])
+        if result is None:
+            raise KeyError(code)
+
+    def delete(self, code: str) -> bool:
+        pipe = self.client.pipeline()
+        pipe.srem(self.prefix + 'rooms', code)
+        pipe.delete(self._room(code), self._messages(code))
+        removed, _ = pipe.execute()
+        return removed > 0
+
+    def stat(self, code: str) -> dict[str, int]:
+        pipe = self.client.pipeline()
+        pipe.hmget(self._room(code), 'members', 'bytes')
+        pipe.llen(self._messages(code))
+        (members, size), count = pipe.execute()
+        if members is None:
+            raise KeyError(code)
+        return {'members': int(members), 'messages': count, 'bytes': int(size or 0)}
+
+    def member_counts(self) -> list[int]:
+        pipe = self.client.pipeline()
+        for code in self.codes():
+            pipe.hget(self._room(code), 'members')
+        return [int(members) for members in pipe.execute() if members is not None]
+
+    def totals(self) -> dict[str, int]:
+        codes = self.codes()
+        pipe = self.client.pipeline()
+        for code in codes:
+            pipe.hmget(self._room(code), 'members', 'bytes')
+        totals = {'rooms': 0, 'members': 0, 'history_bytes': 0}
+        for members, size in pipe.execute():
+            if members is None:
+                continue
+            totals['rooms'] += 1
+            totals['members'] += int(members)
+            totals['history_bytes'] += int(size or 0)
+        return totals
+
+
+def make_room_store(url: str, max_messages: int = 500, max_bytes: int = 256 * 1024) -> RoomStore:
+    """Builds a room store from a URL: `memory://`, `sqlite:///path/to.db` or `redis://host:port/db`."""
+    if url.startswith('memory:'):
+        return MemoryRoomStore(max_messages, max_bytes)
+    if url.startswith('sqlite:///'):
+        return SQLiteRoomStore(url[len('sqlite:///'):], max_messages, max_bytes)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+
+        client = redis.Redis.from_url(url, decode_responses=True)
+        return RedisRoomStore(client, max_messages=max_messages, max_bytes=max_bytes)
+    raise ValueError('Unsupported room store: {0}'.format(url))
+
+
+class RoomReaper:
+    """Expires rooms that have gone quiet, without scanning the room store.
+
+    Each tracked room has one entry in a min-heap keyed on its deadline.
+    Activity only updates a dict, and a popped entry whose room has seen
+    activity since it was pushed is pushed back at the new deadline, so each
+    expiry costs O(log n). Rooms nobody has joined expire after `unjoined_ttl`;
+    rooms with activity expire `idle_ttl` after the last of it.
+
+    Activity is only what this process sees. When `in_use(code)` is given, a
+    due room for which it returns true is kept for another `idle_ttl`, so a
+    room busy on another worker sharing the store isn't expired here.
+    """
+
+    def __init__(
+        self,
+        expire: Callable[[str, str], None],
+        idle_ttl: float = 3600,
+        unjoined_ttl: float = 300,
+        interval: float = 5,
+        in_use: Callable[[str], bool] | None = None,
+    ):
+        self.expire = expire
+        self.in_use = in_use
+        self.idle_ttl = idle_ttl
+        self.unjoined_ttl = unjoined_ttl
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.heap: list[tuple[float, str]] = []
+        self.activity: dict[str, tuple[float, float, str]] = {}
+        self.scheduled: dict[str, float] = {}
+        self.expired = {'idle': 0, 'unjoined': 0}
+        self.kept = 0
+
+    def start(self) -> None:
+        threading.Thread(target=self._loop, name='aibot-reaper', daemon=True).start()
+
+    def created(self, code: str) -> None:
+        self._track(code, self.unjoined_ttl, 'unjoined')
+
+    def touch(self, code: str) -> None:
+        self._track(code, self.idle_ttl, 'idle')
+
+    def forget(self, code: str) -> None:
+        with self.lock:
+            self.activity.pop(code, None)
+            self.scheduled.pop(code, None)
+
+    def _track(self, code: str, ttl: float, reason: str) -> None:
+        now = time.monotonic()
+        with self.lock:
+            self.activity[code] = (now, ttl, reason)
+            # Later deadlines are picked up when the old entry pops; only earlier ones need a push.
+            scheduled = self.scheduled.get(code)
+            if scheduled is None or now + ttl < scheduled:
+                self.scheduled[code] = now + ttl
+                heapq.heappush(self.heap, (now + ttl, code))
+
+    def reap(self, now: float | None = None) -> list[tuple[str, str]]:
+        """Expires every room that is due and returns (code, reason) pairs."""
+        now = time.monotonic() if now is None else now
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, code = heapq.heappop(self.heap)
+                if self.scheduled.get(code) != deadline:
+                    continue
+                last, ttl, reason = self.activity[code]
+                if last + ttl > now:
+                    self.scheduled[code] = last + ttl
+                    heapq.heappush(self.heap, (last + ttl, code))
+                    continue
+                del self.activity[code], self.scheduled[code]
+                due.append((code, reason))
+
+        expired = []
+        for code, reason in due:
+            try:
+                # Checked outside the lock: it reads the room store.
+                if self.in_use is not None and self.in_use(code):
+                    self.kept += 1
+                    self.touch(code)
+                    continue
+                with self.lock:
+                    self.expired[reason] += 1
+                expired.append((code, reason))
+                self.expire(code, reason)
+            except Exception as e:
+                error('Expiring room {0} failed: {1!r}'.format(code, e))
+        return expired
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'tracked': len(self.activity),
+                'heap': len(self.heap),
+                'expired_idle': self.expired['idle'],
+                'expired_unjoined': self.expired['unjoined'],
+                'kept_in_use': self.kept,
+            }
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.reap()
+
+
+#Generation workers
+class Busy(Exception):
+    """Raised when a generation job is shed because the pool is at capacity."""
+
+
+class GenerationPool:
+    """Runs AI generation jobs on a bounded thread pool with admission control.
+
+    At most `max_workers` jobs run at once and jobs for the same room run one
+    at a time in submission order. Up to `max_queued` jobs wait behind them in
+    a global FIFO queue; a room may hold at most `max_per_room` pending jobs.
+    Submissions beyond either limit raise `Busy` instead of queueing, which
+    keeps wait times bounded under overload.
+
+    `on_position(room, ticket, position)` is called whenever a waiting job
+    moves in the queue; position 0 means the job has started.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        max_queued: int = 64,
+        max_per_room: int = 4,
+        on_position: Callable[[str, Any, int], None] | None = None,
+    ):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_per_room = max_per_room
+        self.on_position = on_position
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='aibot')
+        self.lock = threading.Lock()
+        self.waiting: deque[tuple[str, Any, Callable[[], Any]]] = deque()
+        self.active: set[str] = set()
+        self.per_room: dict[str, int] = {}
+        self.positions: dict[Any, int] = {}
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, room: str, job: Callable[[], Any], ticket: Any = None) -> None:
+        with self.lock:
+            if self.per_room.get(room, 0) >= self.max_per_room or len(self.waiting) >= self.max_queued:
+                self.rejected += 1
+                raise Busy(room)
+            self.per_room[room] = self.per_room.get(room, 0) + 1
+            self.submitted += 1
+            self.waiting.append((room, ticket, job))
+            updates = self._dispatch()
+        self._notify(updates)
+
+    def pending(self, room: str) -> int:
+        with self.lock:
+            return self.per_room.get(room, 0)
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'running': self.running,
+                'queued': len(self.waiting),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+            }
+
+    def _dispatch(self) -> list[tuple[str, Any, int]]:
+        """Starts whatever fits; returns position updates. Must hold the lock."""
+        updates = []
+        while self.running < self.max_workers:
+            for i, (room, ticket, job) in enumerate(self.waiting):
+                if room not in self.active:
+                    break
+            else:
+                break
+            del self.waiting[i]
+            self.active.add(room)
+            self.running += 1
+            self.positions.pop(ticket, None)
+            updates.append((room, ticket, 0))
+            self._start(room, job)
+
+        if self.on_position is not None:
+            for i, (room, ticket, _) in enumerate(self.waiting, 1):
+                if self.positions.get(ticket) != i:
+                    self.positions[ticket] = i
+                    updates.append((room, ticket, i))
+        return updates
+
+    def _notify(self, updates: list[tuple[str, Any, int]]) -> None:
+        if self.on_position is None:
+            return
+        for room, ticket, position in updates:
+            try:
+                self.on_position(room, ticket, position)
+            except Exception as e:
+                warning('Queue update failed in room {0}: {1!r}'.format(room, e))
+
+    def _start(self, room: str, job: Callable[[], Any]) -> None:
+        self.executor.submit(self._run, room, job)
+
+    def _run(self, room: str, job: Callable[[], Any]) -> None:
+        try:
+            job()
+        except Exception as e:
+            error('Generation failed in room {0}: {1!r}'.format(room, e))
+        self._finish(room)
+
+    def _finish(self, room: str) -> None:
+        with self.lock:
+            self.active.discard(room)
+            self.running -= 1
+            self.per_room[room] -= 1
+            if not self.per_room[room]:
+                del self.per_room[room]
+            updates = self._dispatch()
+        self._notify(updates)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
+
+
+class AsyncGenerationPool(GenerationPool):
+    """GenerationPool for coroutine jobs, run as tasks on the event loop.
+
+    Admission, per-room ordering and queue positions work as in the base
+    class, but `submit` must be called on the loop and `job()` returns a
+    coroutine. `max_workers` caps concurrent tasks rather than threads.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tasks: set[asyncio.Task] = set()
+
+    def _start(self, room: str, job: Callable[[], Awaitable[Any]]) -> None:
+        # Keep a reference so the task isn't garbage collected mid-generation.
+        task = asyncio.get_running_loop().create_task(self._run_async(room, job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_async(self, room: str, job: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            await job()
+        except Exception as e:
+            error('Generation failed in room {0}: {1!r}'.format(room, e))
+        finally:
+            self._finish(room)
+
+
+#Conversation context
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token) for budgeting prompts."""
+    return len(text) // 4 + 1
+
+
+class ConversationContext:
+    """Builds per-room prompt context that fits a fixed token budget.
+
+    Recent turns are kept verbatim. Once they exceed `budget - summary_tokens`,
+    the oldest turns are folded into a rolling per-room summary by
+    `summarize(previous_summary, turns)`, which runs in the background. A
+    prompt therefore costs at most about `budget` tokens of context however
+    long the room has been talking.
+    """
+
+    def __init__(
+        self,
+        summarize: Callable[[str, list[tuple[str, str]]], str],
+        budget: int = 1024,
+        summary_tokens: int = 256,
+    ):
+        self.summarize = summarize
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aibot-summary')
+        self.lock = threading.Lock()
+        self.turns: dict[str, deque[tuple[str, str, int]]] = {}
+        self.turn_tokens: dict[str, int] = {}
+        self.summaries: dict[str, str] = {}
+        self.folding: dict[str, list[tuple[str, str]]] = {}
+
+    def record(self, room: str, sender: str, text: str) -> None:
+        tokens = estimate_tokens(sender) + estimate_tokens(text)
+        with self.lock:
+            turns = self.turns.setdefault(room, deque())
+            turns.append((sender, text, tokens))
+            total = self.turn_tokens.get(room, 0) + tokens
+            folded = []
+            while len(turns) > 1 and total > self.budget - self.summary_tokens:
+                sender, text, tokens = turns.popleft()
+                total -= tokens
+                folded.append((sender, text))
+            self.turn_tokens[room] = total
+            if not folded:
+                return
+            # Only one summary update runs per room; turns folded meanwhile wait for the next one.
+            start = room not in self.folding
+            self.folding.setdefault(room, []).extend(folded)
+        if start:
+            self.executor.submit(self._fold, room)
+
+    def build(self, room: str) -> str:
+        """Returns the summary and recent turns as prompt text, or '' for a new room."""
+        with self.lock:
+            summary = self.summaries.get(room, '')
+            turns = list(self.turns.get(room, ()))
+        lines = []
+        remaining = self.budget - estimate_tokens(summary)
+        for sender, text, tokens in reversed(turns):
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            lines.append('{0}: {1}'.format(sender, text))
+        lines.reverse()
+        if summary:
+            lines.insert(0, 'Summary of the conversation so far: ' + summary)
+        return '\n'.join(lines)
+
+    def forget(self, room: str) -> None:
+        with self.lock:
+            self.turns.pop(room, None)
+            self.turn_tokens.pop(room, None)
+            self.summaries.pop(room, None)
+            # A running fold stops after its current summary, which _fold then discards.
+            self.folding.pop(room, None)
+
+    def _fold(self, room: str) -> None:
+        while True:
+            with self.lock:
+                turns = self.folding.get(room)
+                if not turns:
+                    self.folding.pop(room, None)
+                    return
+                self.folding[room] = []
+                summary = self.summaries.get(room, '')
+            try:
+                summary = self.summarize(summary, turns)
+            except Exception as e:
+                warning('Summarizing room {0} failed: {1!r}'.format(room, e))
+                continue
+            with self.lock:
+                if room in self.turns:
+                    # Keep the summary inside its share of the budget whatever the model returned.
+                    self.summaries[room] = summary[:self.summary_tokens * 4]
+
+
+#Request batching
+class PromptBatcher:
+    """Collects backend calls for a short window and dispatches them together.
+
+    Calls made within `window` seconds of the first pending call (or until
+    `max_batch` calls are pending) form a batch. If `batch_fn` is given the
+    batch is sent as one request and its results are scattered back in
+    order; otherwise each call is issued concurrently over the shared client
+    on at most `max_concurrency` threads. A longer window and larger batches
+    trade a little latency for throughput.
+
+    Only a `batch_fn` saves backend requests. Without one the batcher just
+    caps concurrency, at the cost of up to `window` of latency and a thread
+    hop per call, so leave it off when callers are already bounded (as
+    GenerationPool's are). Streaming calls (`stream=True`) are never batched:
+    they run on the caller's thread as soon as they are made.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[..., Any],
+        *,
+        window: float = 0.01,
+        max_batch: int = 16,
+        max_concurrency: int = 16,
+        batch_fn: Callable[[list], list] | None = None,
+    ):
+        self.fn = fn
+        self.window = window
+        self.max_batch = max_batch
+        self.batch_fn = batch_fn
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='aibot-batch')
+        self.cond = threading.Condition()
+        self.pending: list[tuple[tuple, dict, Future]] = []
+        self.batches = 0
+        self.calls = 0
+        threading.Thread(target=self._loop, name='aibot-batcher', daemon=True).start()
+
+    def __call__(self, *args, **kwargs):
+        if kwargs.get('stream'):
+            # The batch thread would only create the generator; the caller consumes it anyway.
+            return self.fn(*args, **kwargs)
+        return self.submit(*args, **kwargs).result()
+
+    def submit(self, *args, **kwargs) -> Future:
+        future = Future()
+        with self.cond:
+            self.pending.append((args, kwargs, future))
+            self.cond.notify()
+        return future
+
+    def stats(self) -> dict[str, float]:
+        with self.cond:
+            return {
+                'batches': self.batches,
+                'calls': self.calls,
+                'mean_batch_size': self.calls / self.batches if self.batches else 0.0,
+            }
+
+    def _loop(self) -> None:
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                self.batches += 1
+                self.calls += len(batch)
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: list[tuple[tuple, dict, Future]]) -> None:
+        if self.batch_fn is not None:
+            self.executor.submit(self._run_batch, batch)
+            return
+        for args, kwargs, future in batch:
+            self.executor.submit(self._run_one, args, kwargs, future)
+
+    def _run_one(self, args: tuple, kwargs: dict, future: Future) -> None:
+        try:
+            future.set_result(self.fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _run_batch(self, batch: list[tuple[tuple, dict, Future]]) -> None:
+        try:
+            results = self.batch_fn([(args, kwargs) for args, kwargs, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+#Request coalescing
+class SingleFlight:
+    """Collapses concurrent calls that share a key into a single call.
+
+    The first caller for a key runs the function; callers that arrive while it
+    is still running get the same `Future` back and share its result.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[str, Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> tuple[Future, bool]:
+        """Returns the call's future and whether this caller ran it."""
+        future, leader = self._join(key)
+        if leader:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._leave(key)
+        return future, leader
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> tuple[Future, bool]:
+        """`do` for coroutine functions; followers can wait on `asyncio.wrap_future(future)`."""
+        future, leader = self._join(key)
+        if leader:
+            try:
+                future.set_result(await fn())
+            except Exception as e:
+                future.set_exception(e)
+            except BaseException:
+                future.cancel()
+                raise
+            finally:
+                self._leave(key)
+        return future, leader
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.followers += 1
+                return future, False
+            future = self.calls[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def _leave(self, key: str) -> None:
+        with self.lock:
+            del self.calls[key]
+
+    def in_flight(self) -> int:
+        with self.lock:
+            return len(self.calls)
+
+
+#Response caching
+_PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Folds case, punctuation and whitespace so trivially different prompts share a cache entry."""
+    return ' '.join(prompt.casefold().translate(_PUNCTUATION).split())
+
+
+class ResponseCache:
+    """LRU cache of generated replies with a per-entry TTL.
+
+    The cache is bounded both by entry count and by the total size of the
+    cached text. When `path` is given, entries are loaded from it on start-up
+    and written back every `persist_every` writes and on `save()`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 4 * 1024 * 1024,
+        ttl: float = 3600,
+        path: str | None = None,
+        persist_every: int = 50,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.persist_every = persist_every
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # Serializes writers of `path`; held apart from `lock` so lookups never wait on disk I/O.
+        self.save_lock = threading.Lock()
+        self._unsaved = 0
+        if path is not None:
+            self.load()
+
+    @staticmethod
+    def key(prompt: str, suffix: str = '', **settings) -> str:
+        return json.dumps([normalize_prompt(prompt), suffix, settings], sort_keys=True)
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, text: str, ttl: float | None = None) -> None:
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires, text)
+            self.size += len(text)
+            self._evict()
+            self._unsaved += 1
+            save = self.path is not None and self._unsaved >= self.persist_every
+        if save:
+            self.save()
+
+    def _remove(self, key: str) -> None:
+        _, text = self.entries.pop(key)
+        self.size -= len(text)
+
+    def _evict(self) -> None:
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if not isinstance(entries, list) or not all(self._valid_entry(entry) for entry in entries):
+            warning('Ignoring malformed response cache file {0}'.format(self.path))
+            return
+        now = time.time()
+        with self.lock:
+            for key, expires, text in entries:
+                if expires > now:
+                    self.entries[key] = (expires, text)
+                    self.size += len(text)
+            self._evict()
+
+    @staticmethod
+    def _valid_entry(entry: Any) -> bool:
+        return (
+            isinstance(entry, list)
+            and len(entry) == 3
+            and isinstance(entry[0], str)
+            and isinstance(entry[1], (int, float))
+            and isinstance(entry[2], str)
+        )
+
+    def save(self) -> None:
+        """Writes the cache to `path`; failures are logged, never raised, since callers are mid-reply."""
+        if self.path is None:
+            return
+        with self.save_lock:
+            with self.lock:
+                entries = [[key, expires, text] for key, (expires, text) in self.entries.items()]
+                self._unsaved = 0
+            tmp = None
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+                with open(fd, 'w', encoding='utf-8') as fp:
+                    json.dump(entries, fp)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                error('Saving response cache to {0} failed: {1!r}'.format(self.path, e))
+                if tmp is not None:
+                    try:
+                        os.unlink(tmp)
+                    except OSError:
+                        pass
+
+
+#Generation profiles
+@dataclasses.dataclass(frozen=True)
+class GenerationProfile:
+    """Named output settings for a room's replies.
+
+    `max_output_tokens` is a hard cap enforced by the backend, `words` is the
+    length hint appended to the prompt, and `model` picks a model tier (None
+    is the default `aiLib` model).
+    """
+
+    name: str
+    max_output_tokens: int
+    words: int = 60
+    temperature: float = 0.7
+    model: str | None = None
+
+    @property
+    def suffix(self) -> str:
+        return ' in about {0} words.'.format(self.words)
+
+    def generation_config(self) -> dict[str, Any]:
+        return {'max_output_tokens': self.max_output_tokens, 'temperature': self.temperature}
+
+
+# Ordered from best to fastest; ProfileSelector steps down this list under load.
+DEFAULT_PROFILES = (
+    GenerationProfile('quality', max_output_tokens=160, words=60),
+    GenerationProfile('balanced', max_output_tokens=100, words=40),
+    GenerationProfile('fast', max_output_tokens=60, words=25, temperature=0.5),
+)
+
+
+def load_profiles(spec: str | None) -> tuple[GenerationProfile, ...]:
+    """Parses a JSON list of profile fields, falling back to DEFAULT_PROFILES."""
+    if not spec:
+        return DEFAULT_PROFILES
+    return tuple(GenerationProfile(**fields) for fields in json.loads(spec))
+
+
+class ProfileSelector:
+    """Steps down to faster profiles when model latency breaks its SLO.
+
+    The p95 of the last `window` model-call latencies is compared against
+    `slo` seconds. Above it, the selector moves one profile faster; below
+    `slo * recover_ratio` it moves one back towards the best profile. The
+    window is cleared after each move so every decision uses fresh samples.
+    An `slo` of 0 disables automatic selection.
+    """
+
+    def __init__(
+        self,
+        profiles: Sequence[GenerationProfile],
+        slo: float,
+        window: int = 50,
+        min_samples: int = 20,
+        recover_ratio: float = 0.6,
+    ):
+        self.profiles = tuple(profiles)
+        self.by_name = {profile.name: i for i, profile in enumerate(self.profiles)}
+        self.slo = slo
+        self.min_samples = min_samples
+        self.recover_ratio = recover_ratio
+        self.samples: deque[float] = deque(maxlen=window)
+        self.level = 0
+        self.switches = 0
+        self.lock = threading.Lock()
+
+    def select(self, name: str | None = None) -> GenerationProfile:
+        """Returns the named profile, or a faster one if latency currently requires it."""
+        return self.profiles[max(self.by_name.get(name, 0), self.level)]
+
+    def observe(self, latency: float) -> None:
+        if self.slo <= 0:
+            return
+        with self.lock:
+            self.samples.append(latency)
+            if len(self.samples) < self.min_samples:
+                return
+            ordered = sorted(self.samples)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            if p95 > self.slo and self.level < len(self.profiles) - 1:
+                self.level += 1
+            elif p95 < self.slo * self.recover_ratio and self.level > 0:
+                self.level -= 1
+            else:
+                return
+            self.switches += 1
+            self.samples.clear()
+        warning('Generation profile switched to {0} (p95 {1:.2f}s)'.format(self.profiles[self.level].name, p95))
+
+    def stats(self) -> dict[str, float]:
+        with self.lock:
+            return {'level': self.level, 'switches': self.switches}
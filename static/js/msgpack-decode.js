@@ -0,0 +1,78 @@
+// Minimal MessagePack decoder for the room event protocol (see utils.RoomBroadcaster).
+// Served from our own origin so the page doesn't load third-party code. Handles every
+// type except extensions, which the server never sends.
+(function (global) {
+  var utf8 = new TextDecoder("utf-8");
+
+  function decode(bytes) {
+    var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    var pos = 0;
+
+    function str(length) {
+      var value = utf8.decode(bytes.subarray(pos, pos + length));
+      pos += length;
+      return value;
+    }
+
+    function bin(length) {
+      var value = bytes.slice(pos, pos + length);
+      pos += length;
+      return value;
+    }
+
+    function array(length) {
+      var value = new Array(length);
+      for (var i = 0; i < length; i++) value[i] = read();
+      return value;
+    }
+
+    function map(length) {
+      var value = {};
+      for (var i = 0; i < length; i++) {
+        var key = read();
+        value[key] = read();
+      }
+      return value;
+    }
+
+    function read() {
+      var type = view.getUint8(pos++);
+      var value;
+      if (type < 0x80) return type;
+      if (type < 0x90) return map(type & 0x0f);
+      if (type < 0xa0) return array(type & 0x0f);
+      if (type < 0xc0) return str(type & 0x1f);
+      if (type >= 0xe0) return type - 0x100;
+      switch (type) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: return bin(view.getUint8(pos++));
+        case 0xc5: value = view.getUint16(pos); pos += 2; return bin(value);
+        case 0xc6: value = view.getUint32(pos); pos += 4; return bin(value);
+        case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+        case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+        case 0xcc: return view.getUint8(pos++);
+        case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+        case 0xce: value = view.getUint32(pos); pos += 4; return value;
+        case 0xcf: value = view.getUint32(pos) * 4294967296 + view.getUint32(pos + 4); pos += 8; return value;
+        case 0xd0: return view.getInt8(pos++);
+        case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+        case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+        case 0xd3: value = view.getInt32(pos) * 4294967296 + view.getUint32(pos + 4); pos += 8; return value;
+        case 0xd9: return str(view.getUint8(pos++));
+        case 0xda: value = view.getUint16(pos); pos += 2; return str(value);
+        case 0xdb: value = view.getUint32(pos); pos += 4; return str(value);
+        case 0xdc: value = view.getUint16(pos); pos += 2; return array(value);
+        case 0xdd: value = view.getUint32(pos); pos += 4; return array(value);
+        case 0xde: value = view.getUint16(pos); pos += 2; return map(value);
+        case 0xdf: value = view.getUint32(pos); pos += 4; return map(value);
+      }
+      throw new Error("Unsupported MessagePack type 0x" + type.toString(16));
+    }
+
+    return read();
+  }
+
+  global.MessagePack = { decode: decode };
+})(window);
@@ -0,0 +1,100 @@
+import json
+import threading
+
+import pytest
+
+from serving import ResponseCache, SingleFlight
+
+
+def test_expired_entries_miss():
+    cache = ResponseCache()
+    cache.set('fresh', 'a')
+    cache.set('stale', 'b', ttl=-1)
+    assert cache.get('fresh') == 'a'
+    assert cache.get('stale') is None
+    assert cache.stats()['entries'] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.set('c', '3')
+    assert cache.get('b') is None
+    assert cache.get('a') == '1'
+    assert cache.get('c') == '3'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_are_evicted_past_max_bytes():
+    cache = ResponseCache(max_bytes=10)
+    cache.set('a', 'x' * 6)
+    cache.set('b', 'y' * 6)
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 6
+
+
+def test_key_ignores_case_and_punctuation():
+    assert ResponseCache.key('Hello, world!') == ResponseCache.key('hello world')
+    assert ResponseCache.key('hello', ' in about 60 words.') != ResponseCache.key('hello', ' in about 25 words.')
+
+
+def test_entries_are_reloaded_from_path(tmp_path):
+    path = str(tmp_path / 'cache.json')
+    cache = ResponseCache(path=path, persist_every=100)
+    cache.set('kept', 'a')
+    cache.set('expired', 'b', ttl=-1)
+    cache.save()
+
+    reloaded = ResponseCache(path=path)
+    assert reloaded.get('kept') == 'a'
+    assert reloaded.get('expired') is None
+    assert reloaded.stats()['entries'] == 1
+
+
+def test_malformed_cache_file_is_ignored(tmp_path):
+    path = tmp_path / 'cache.json'
+    path.write_text(json.dumps([['key', 'not a time', 'text']]))
+    assert ResponseCache(path=str(path)).stats()['entries'] == 0
+
+
+def test_concurrent_calls_share_the_leaders_result():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def leader():
+        calls.append('leader')
+        started.set()
+        release.wait(5)
+        return 'reply'
+
+    results = {}
+    thread = threading.Thread(target=lambda: results.update(leader=flight.do('key', leader)))
+    thread.start()
+    assert started.wait(5)
+    future, is_leader = flight.do('key', lambda: calls.append('follower'))
+    assert not is_leader
+    assert flight.in_flight() == 1
+    release.set()
+    thread.join()
+
+    assert future.result() == 'reply'
+    assert results['leader'] == (future, True)
+    assert calls == ['leader']
+    assert flight.in_flight() == 0
+
+
+def test_leader_failure_is_shared_and_the_key_is_released():
+    flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError('backend down')
+
+    future, leader = flight.do('key', fail)
+    assert leader
+    with pytest.raises(RuntimeError):
+        future.result()
+    future, leader = flight.do('key', lambda: 'reply')
+    assert leader and future.result() == 'reply'
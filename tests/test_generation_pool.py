@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+from serving import Busy, GenerationPool
+
+
+@pytest.fixture
+def pool():
+    pool = GenerationPool(max_workers=4, max_queued=8, max_per_room=4)
+    yield pool
+    pool.shutdown()
+
+
+def test_jobs_for_a_room_run_one_at_a_time_in_order(pool):
+    release = threading.Event()
+    done = threading.Semaphore(0)
+    order, running = [], []
+
+    def job(i):
+        def run():
+            running.append(i)
+            assert len(running) == 1
+            if i == 0:
+                release.wait(5)
+            order.append(i)
+            running.remove(i)
+            done.release()
+        return run
+
+    for i in range(4):
+        pool.submit('ROOM', job(i))
+    assert pool.pending('ROOM') == 4
+    release.set()
+    for _ in range(4):
+        assert done.acquire(timeout=5)
+    assert order == [0, 1, 2, 3]
+
+
+def test_other_rooms_run_while_a_room_is_busy(pool):
+    release = threading.Event()
+    other = threading.Event()
+    pool.submit('A', lambda: release.wait(5))
+    pool.submit('A', lambda: None)
+    pool.submit('B', other.set)
+    assert other.wait(5)
+    release.set()
+
+
+def test_submissions_past_the_room_limit_are_shed():
+    pool = GenerationPool(max_workers=1, max_queued=8, max_per_room=2)
+    release = threading.Event()
+    pool.submit('ROOM', lambda: release.wait(5))
+    pool.submit('ROOM', lambda: None)
+    with pytest.raises(Busy):
+        pool.submit('ROOM', lambda: None)
+    pool.submit('OTHER', lambda: None)
+    assert pool.stats()['rejected'] == 1
+    release.set()
+    pool.shutdown()
+
+
+def test_submissions_past_the_queue_limit_are_shed():
+    positions = []
+    pool = GenerationPool(max_workers=1, max_queued=2, on_position=lambda room, ticket, position: positions.append((ticket, position)))
+    release, done = threading.Event(), threading.Event()
+    pool.submit('A', lambda: release.wait(5), ticket='a')
+    pool.submit('B', lambda: None, ticket='b')
+    pool.submit('C', done.set, ticket='c')
+    with pytest.raises(Busy):
+        pool.submit('D', lambda: None, ticket='d')
+    assert positions == [('a', 0), ('b', 1), ('c', 2)]
+
+    release.set()
+    assert done.wait(5)
+    pool.shutdown()
+    assert positions[3:] == [('b', 0), ('c', 1), ('c', 0)]
+    assert pool.stats() == {'running': 0, 'queued': 0, 'submitted': 3, 'rejected': 1}
@@ -0,0 +1,55 @@
+import pytest
+
+from serving import DEFAULT_PROFILES, ProfileSelector, load_profiles
+
+
+@pytest.fixture
+def selector():
+    return ProfileSelector(DEFAULT_PROFILES, slo=1.0, window=10, min_samples=5)
+
+
+def observe(selector, latency, count=5):
+    for _ in range(count):
+        selector.observe(latency)
+
+
+def test_steps_down_one_profile_per_slow_window(selector):
+    observe(selector, 2.0, count=4)
+    assert selector.select().name == 'quality'
+    observe(selector, 2.0, count=1)
+    assert selector.select().name == 'balanced'
+    observe(selector, 2.0)
+    assert selector.select().name == 'fast'
+    observe(selector, 2.0)
+    assert selector.select().name == 'fast'
+    assert selector.stats() == {'level': 2, 'switches': 2}
+
+
+def test_recovers_once_latency_is_well_under_the_slo(selector):
+    observe(selector, 2.0)
+    observe(selector, 0.8)
+    assert selector.select().name == 'balanced'
+    # The slower samples have to leave the window first.
+    observe(selector, 0.1, count=9)
+    assert selector.select().name == 'balanced'
+    observe(selector, 0.1, count=1)
+    assert selector.select().name == 'quality'
+
+
+def test_named_profiles_are_only_ever_made_faster(selector):
+    assert selector.select('fast').name == 'fast'
+    observe(selector, 2.0)
+    assert selector.select('quality').name == 'balanced'
+    assert selector.select('missing').name == 'balanced'
+
+
+def test_zero_slo_disables_selection():
+    selector = ProfileSelector(DEFAULT_PROFILES, slo=0)
+    observe(selector, 100.0, count=50)
+    assert selector.select().name == 'quality'
+
+
+def test_profiles_load_from_json():
+    assert load_profiles(None) is DEFAULT_PROFILES
+    profiles = load_profiles('[{"name": "only", "max_output_tokens": 10, "model": "small"}]')
+    assert [(p.name, p.max_output_tokens, p.model) for p in profiles] == [('only', 10, 'small')]
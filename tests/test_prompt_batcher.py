@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+from serving import PromptBatcher
+
+
+def test_calls_in_a_window_are_sent_as_one_batch():
+    batches = []
+
+    def batch_fn(calls):
+        batches.append(calls)
+        return [args[0].upper() for args, _ in calls]
+
+    batcher = PromptBatcher(lambda prompt: prompt, window=1, max_batch=3, batch_fn=batch_fn)
+    futures = [batcher.submit(prompt) for prompt in ('a', 'b', 'c')]
+    assert [future.result(5) for future in futures] == ['A', 'B', 'C']
+    assert batches == [[(('a',), {}), (('b',), {}), (('c',), {})]]
+    assert batcher.stats() == {'batches': 1, 'calls': 3, 'mean_batch_size': 3.0}
+
+
+def test_batch_failure_is_raised_to_every_caller():
+    def batch_fn(calls):
+        raise RuntimeError('backend down')
+
+    batcher = PromptBatcher(lambda prompt: prompt, window=1, max_batch=2, batch_fn=batch_fn)
+    futures = [batcher.submit('a'), batcher.submit('b')]
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(5)
+
+
+def test_calls_run_individually_without_batch_fn():
+    batcher = PromptBatcher(lambda prompt, suffix='': prompt + suffix, window=0.01)
+    assert batcher('hello', suffix='!') == 'hello!'
+
+
+def test_streaming_calls_bypass_the_batch():
+    threads = []
+
+    def stream(prompt, stream=False):
+        threads.append(threading.current_thread())
+        return iter(prompt)
+
+    batcher = PromptBatcher(stream, window=1)
+    assert list(batcher('ab', stream=True)) == ['a', 'b']
+    assert threads == [threading.current_thread()]
+    assert batcher.stats()['calls'] == 0
@@ -0,0 +1,103 @@
+import json
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+
+from serving import RedisRoomStore
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture
+def store(client):
+    return RedisRoomStore(client, max_messages=50)
+
+
+def stored_items(client, store, code):
+    return [json.loads(item) for item in client.lrange(store._messages(code), 0, -1)]
+
+
+def test_concurrent_appends_stay_in_seq_order(client, store):
+    store.create('ROOM')
+
+    def append(worker):
+        for i in range(100):
+            store.append_message('ROOM', {'sender': 'user{0}'.format(worker), 'message': 'héllo {0}'.format(i)})
+
+    threads = [threading.Thread(target=append, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    items = stored_items(client, store, 'ROOM')
+    assert [item['seq'] for item in items] == list(range(350, 400))
+    assert store.stat('ROOM') == {
+        'members': 0,
+        'messages': 50,
+        'bytes': sum(len(item['sender']) + len(item['message']) for item in items),
+    }
+
+
+def test_writes_to_deleted_room_leave_no_keys(client, store):
+    store.create('ROOM')
+    store.delete('ROOM')
+
+    with pytest.raises(KeyError):
+        store.add_member('ROOM')
+    with pytest.raises(KeyError):
+        store.append_message('ROOM', {'sender': 'a', 'message': 'b'})
+    assert client.keys('*') == []
+
+
+def test_add_member(store):
+    store.create('ROOM')
+    assert store.add_member('ROOM') == 1
+    assert store.add_member('ROOM', -1) == 0
+
+
+def test_history_pages_by_seq(store):
+    store.create('ROOM')
+    for i in range(60):
+        store.append_message('ROOM', {'sender': 'user', 'message': str(i)})
+
+    pages, cursor = [], None
+    while True:
+        messages, cursor = store.history('ROOM', cursor, 20)
+        pages.append([int(message['message']) for message in messages])
+        if cursor is None:
+            break
+    assert pages == [list(range(40, 60)), list(range(20, 40)), list(range(10, 20))]
+
+
+def test_profile_is_shared_through_the_store(client, store):
+    store.create('ROOM')
+    RedisRoomStore(client).set_profile('ROOM', 'fast')
+    assert store.profile('ROOM') == 'fast'
+    store.set_profile('ROOM', None)
+    assert store.profile('ROOM') is None
+
+    store.delete('ROOM')
+    with pytest.raises(KeyError):
+        store.set_profile('ROOM', 'fast')
+    assert client.keys('*') == []
+
+
+def test_history_is_trimmed_to_max_bytes(client):
+    store = RedisRoomStore(client, max_messages=50, max_bytes=100)
+    store.create('ROOM')
+    for i in range(10):
+        store.append_message('ROOM', {'sender': 'user', 'message': str(i) * 16})
+
+    items = stored_items(client, store, 'ROOM')
+    assert [item['seq'] for item in items] == [5, 6, 7, 8, 9]
+    assert store.stat('ROOM')['bytes'] == 100
+
+    store.append_message('ROOM', {'sender': 'user', 'message': 'x' * 200})
+    assert [item['seq'] for item in stored_items(client, store, 'ROOM')] == [10]
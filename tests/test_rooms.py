@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+from serving import RoomCodeAllocator, RoomHistory, RoomReaper
+
+
+def message(text):
+    return {'sender': 'user', 'message': text}
+
+
+def test_history_pages_back_from_the_newest_message():
+    history = RoomHistory(max_messages=10)
+    for i in range(5):
+        assert history.append(message(str(i))) == i
+
+    page, cursor = history.before(None, 2)
+    assert [m['message'] for m in page] == ['3', '4']
+    page, cursor = history.before(cursor, 2)
+    assert [m['message'] for m in page] == ['1', '2']
+    page, cursor = history.before(cursor, 2)
+    assert [m['message'] for m in page] == ['0']
+    assert cursor is None
+
+
+def test_history_evicts_past_either_limit():
+    history = RoomHistory(max_messages=3, max_bytes=1000)
+    for i in range(5):
+        history.append(message(str(i)))
+    assert len(history) == 3 and history.first_seq == 2
+
+    history = RoomHistory(max_messages=10, max_bytes=20)
+    for i in range(4):
+        history.append(message(str(i) * 6))
+    assert len(history) == 2 and history.size == 20
+    history.append(message('x' * 50))
+    assert len(history) == 1
+
+
+def test_history_cursor_past_evicted_messages_ends_paging():
+    history = RoomHistory(max_messages=2)
+    for i in range(5):
+        history.append(message(str(i)))
+    assert history.before(2, 10) == ([], None)
+    page, cursor = history.before(None, 10)
+    assert [m['message'] for m in page] == ['3', '4'] and cursor is None
+
+
+def test_allocated_codes_are_unique_and_skip_taken_ones():
+    taken = {'aa', 'ab', 'ba'}
+    allocator = RoomCodeAllocator(length=2, alphabet='ab', max_load=1, taken=taken.__contains__)
+    assert allocator.allocate() == 'bb'
+    assert allocator.stats()['live'] == 1
+
+
+def test_codes_grow_once_the_load_limit_is_passed():
+    allocator = RoomCodeAllocator(length=2, alphabet='ab', max_load=0.5)
+    codes = {allocator.allocate() for _ in range(3)}
+    assert len(codes) == 3
+    assert allocator.length == 3
+    assert len(allocator.allocate()) == 3
+
+
+def test_released_codes_can_be_reused():
+    allocator = RoomCodeAllocator(length=1, alphabet='a', max_load=1)
+    code = allocator.allocate()
+    allocator.release(code)
+    assert allocator.allocate() == code
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+
+def test_unjoined_rooms_expire_after_unjoined_ttl(clock):
+    expired = []
+    reaper = RoomReaper(lambda code, reason: expired.append((code, reason)), idle_ttl=100, unjoined_ttl=10)
+    reaper.created('ROOM')
+    assert reaper.reap(clock.now + 9) == []
+    assert reaper.reap(clock.now + 10) == [('ROOM', 'unjoined')]
+    assert expired == [('ROOM', 'unjoined')]
+    assert reaper.stats()['tracked'] == 0
+
+
+def test_activity_pushes_the_room_back_on_the_heap(clock):
+    reaper = RoomReaper(lambda code, reason: None, idle_ttl=100, unjoined_ttl=10)
+    reaper.created('ROOM')
+    clock.now += 5
+    reaper.touch('ROOM')
+    reaper.touch('ROOM')
+    # A later deadline doesn't push; the stale entry is re-pushed when it pops.
+    assert reaper.stats()['heap'] == 1
+
+    assert reaper.reap(clock.now + 50) == []
+    assert reaper.heap == [(clock.now + 100, 'ROOM')]
+    assert reaper.reap(clock.now + 100) == [('ROOM', 'idle')]
+
+
+def test_rooms_in_use_elsewhere_are_kept(clock):
+    reaper = RoomReaper(lambda code, reason: None, idle_ttl=100, unjoined_ttl=10, in_use=lambda code: True)
+    reaper.created('ROOM')
+    assert reaper.reap(clock.now + 10) == []
+    assert reaper.stats()['kept_in_use'] == 1
+    assert reaper.stats()['tracked'] == 1
+
+
+def test_forgotten_rooms_are_not_expired(clock):
+    expired = []
+    reaper = RoomReaper(lambda code, reason: expired.append(code), idle_ttl=100, unjoined_ttl=10)
+    reaper.created('ROOM')
+    reaper.forget('ROOM')
+    assert reaper.reap(clock.now + 10) == []
+    assert expired == []
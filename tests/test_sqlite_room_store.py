@@ -0,0 +1,42 @@
+import pytest
+
+from serving import SQLiteRoomStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteRoomStore(str(tmp_path / 'rooms.db'), max_messages=50, max_bytes=100)
+
+
+def stored(store, code):
+    messages, _ = store.history(code, None, 100)
+    return [message['message'] for message in messages]
+
+
+def test_history_is_trimmed_to_max_messages(tmp_path):
+    store = SQLiteRoomStore(str(tmp_path / 'rooms.db'), max_messages=3)
+    store.create('ROOM')
+    for i in range(5):
+        store.append_message('ROOM', {'sender': 'user', 'message': str(i)})
+    assert stored(store, 'ROOM') == ['2', '3', '4']
+
+
+def test_history_is_trimmed_to_max_bytes(store):
+    store.create('ROOM')
+    for i in range(10):
+        store.append_message('ROOM', {'sender': 'user', 'message': str(i) * 16})
+    assert stored(store, 'ROOM') == [str(i) * 16 for i in range(5, 10)]
+    assert store.stat('ROOM')['bytes'] == 100
+
+    # A message larger than max_bytes is still kept on its own.
+    store.append_message('ROOM', {'sender': 'user', 'message': 'x' * 200})
+    assert stored(store, 'ROOM') == ['x' * 200]
+
+
+def test_deleted_room_rejects_writes(store):
+    store.create('ROOM')
+    store.delete('ROOM')
+    with pytest.raises(KeyError):
+        store.append_message('ROOM', {'sender': 'a', 'message': 'b'})
+    with pytest.raises(KeyError):
+        store.add_member('ROOM')
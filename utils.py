@@ -1,6 +1,13 @@
 from __future__ import annotations
 
+from time import perf_counter as _perf_counter
+
+# Seconds spent in each slow part of startup, reported by /ready.
+IMPORT_PROFILE: dict[str, float] = {}
+_import_started = _perf_counter()
+
 import asyncio
+import dataclasses
 import datetime
 import re
 import io
@@ -9,10 +16,12 @@ from typing import (
     Dict,
     TYPE_CHECKING,
     Sequence,
+    Iterable,
     Union,
     List,
     Optional,
     Any,
+    Awaitable,
     Callable,
     Tuple,
     ClassVar,
@@ -20,10 +29,22 @@ from typing import (
     overload,
 )
 
+_started = _perf_counter()
 from AILibrary import *
+IMPORT_PROFILE['AILibrary'] = _perf_counter() - _started
 import random
-from string import ascii_letters
-from colorama import *
+import hashlib
+import json
+import mimetypes
+import os
+import stat
+import tempfile
+import threading
+import time
+import weakref
+from serving import error, info, warning
+# The message graph below is needed to define Message and generate_text, so it can't be deferred.
+_started = _perf_counter()
 from . import utils
 from .asset import Asset
 from .reaction import Reaction
@@ -38,6 +59,7 @@ from .guild import Guild
 from .threads import Thread
 from .thread import PartialMessageable
 from .poll import Poll
+IMPORT_PROFILE['message graph'] = _perf_counter() - _started
 
 if TYPE_CHECKING:
     from typing_extensions import Self
@@ -90,32 +112,284 @@ __all__ = (
 
 
 
+# AI generators
 
-init(autoreset=True)
+class FakeResponse:
+    """Stand-in for a generate_content response or stream chunk."""
 
-#Flask and frontend functions
-def generate_room_code(length: int, existing_codes: list[str]) -> str:
-    while True:
-        code_chars = [random.choice(ascii_letters) for _ in range(length)]
-        code = ''.join(code_chars)
+    def __init__(self, text: str):
+        self.text = text
 
-        if code not in existing_codes:
-            return code
+    def __repr__(self) -> str:
+        return 'FakeResponse({0!r})'.format(self.text)
 
-def new_connection(txt:str):
-    print(Fore.GREEN + Style.BRIGHT + '[CONNECT]: ', end='')
-    print(Style.BRIGHT + txt)
-def delete_connection(txt:str):
-    print(Fore.RED + Style.BRIGHT + '[DISCONNECT]: ', end='')
-    print(Style.BRIGHT + txt)
-def info(txt:str):
-    print(Fore.BLUE + Style.BRIGHT + '[INFO]: ', end='')
-    print(Style.BRIGHT + txt)
 
+class FakeGenerativeModel:
+    """Offline replacement for `aiLib` used to benchmark and test the chat path.
+
+    Replies are built from a seeded RNG keyed on the prompt, so the same prompt
+    always gets the same text. `latency` picks how long a call takes:
+    `fixed:SECONDS`, `lognormal:MU,SIGMA` or `pareto:ALPHA,SCALE` (heavy tail).
+    `error_rate` is the fraction of calls that raise; a failing stream raises
+    halfway through, sync or async. Streamed replies yield `words_per_chunk`
+    words every `chunk_delay` seconds. A
+    `generation_config` with `max_output_tokens` caps the reply length.
+    """
+
+    WORDS = (
+        'the', 'a', 'model', 'answer', 'space', 'light', 'history', 'energy', 'people', 'learn',
+        'quantum', 'planet', 'simple', 'because', 'many', 'world', 'question', 'idea', 'time', 'life',
+    )
+
+    def __init__(
+        self,
+        latency: str = 'fixed:0',
+        error_rate: float = 0.0,
+        words: int = 60,
+        chunk_delay: float = 0.02,
+        words_per_chunk: int = 5,
+        seed: int = 0,
+        model_name: str = 'fake',
+    ):
+        self.latency = latency
+        self.sample_latency = self._latency_sampler(latency)
+        self.error_rate = error_rate
+        self.words = words
+        self.chunk_delay = chunk_delay
+        self.words_per_chunk = words_per_chunk
+        self.seed = seed
+        self.model_name = model_name
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix: str = 'FAKE_AI_') -> FakeGenerativeModel:
+        env = os.environ
+        return cls(
+            latency=env.get(prefix + 'LATENCY', 'fixed:0'),
+            error_rate=float(env.get(prefix + 'ERROR_RATE', 0)),
+            words=int(env.get(prefix + 'WORDS', 60)),
+            chunk_delay=float(env.get(prefix + 'CHUNK_DELAY', 0.02)),
+            words_per_chunk=int(env.get(prefix + 'WORDS_PER_CHUNK', 5)),
+            seed=int(env.get(prefix + 'SEED', 0)),
+        )
+
+    def _latency_sampler(self, spec: str) -> Callable[[random.Random], float]:
+        kind, _, params = spec.partition(':')
+        values = [float(v) for v in params.split(',') if v]
+        if kind == 'fixed':
+            return lambda rng: values[0] if values else 0.0
+        if kind == 'lognormal':
+            return lambda rng: rng.lognormvariate(values[0], values[1])
+        if kind == 'pareto':
+            return lambda rng: values[1] * rng.paretovariate(values[0])
+        raise ValueError('Unknown latency distribution: {0}'.format(spec))
+
+    def _reply(self, contents: Any, generation_config: dict | None = None) -> str:
+        digest = hashlib.sha256('{0}:{1}'.format(self.seed, contents).encode()).digest()
+        rng = random.Random(digest)
+        words = self.words
+        if generation_config and generation_config.get('max_output_tokens'):
+            words = min(words, max(1, generation_config['max_output_tokens'] * 3 // 4))
+        return ' '.join(rng.choice(self.WORDS) for _ in range(words)).capitalize() + '.'
+
+    def _call(self) -> tuple[float, bool]:
+        with self.lock:
+            return self.sample_latency(self.rng), self.rng.random() < self.error_rate
+
+    def generate_content(self, contents: Any, *, stream: bool = False, generation_config: dict | None = None, **kwargs):
+        delay, fail = self._call()
+        text = self._reply(contents, generation_config)
+        if not stream:
+            time.sleep(delay)
+            if fail:
+                raise RuntimeError('Injected fake backend error')
+            return FakeResponse(text)
+        return self._stream(text, delay, fail)
+
+    def _stream(self, text: str, delay: float, fail: bool):
+        time.sleep(delay)
+        words = text.split(' ')
+        for i in range(0, len(words), self.words_per_chunk):
+            if fail and i >= len(words) // 2:
+                raise RuntimeError('Injected fake backend error')
+            if i:
+                time.sleep(self.chunk_delay)
+            yield FakeResponse(' '.join(words[i:i + self.words_per_chunk]) + ' ')
+
+    async def generate_content_async(self, contents: Any, *, stream: bool = False, generation_config: dict | None = None, **kwargs):
+        delay, fail = self._call()
+        text = self._reply(contents, generation_config)
+        if not stream:
+            await asyncio.sleep(delay)
+            if fail:
+                raise RuntimeError('Injected fake backend error')
+            return FakeResponse(text)
+        return self._stream_async(text, delay, fail)
+
+    async def _stream_async(self, text: str, delay: float, fail: bool):
+        await asyncio.sleep(delay)
+        words = text.split(' ')
+        for i in range(0, len(words), self.words_per_chunk):
+            if fail and i >= len(words) // 2:
+                raise RuntimeError('Injected fake backend error')
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            yield FakeResponse(' '.join(words[i:i + self.words_per_chunk]) + ' ')
+
+
+def _fake_proto(response: FakeResponse, finished: bool = True) -> protos.GenerateContentResponse:
+    candidate = protos.Candidate(
+        index=0,
+        content=protos.Content(role='model', parts=[protos.Part(text=response.text)]),
+        finish_reason=protos.Candidate.FinishReason.STOP if finished else protos.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+    )
+    return protos.GenerateContentResponse(candidates=[candidate])
+
+
+def _fake_proto_stream(chunks):
+    # Only the last chunk of a real stream carries a finish reason.
+    previous = None
+    for chunk in chunks:
+        if previous is not None:
+            yield _fake_proto(previous, finished=False)
+        previous = chunk
+    if previous is not None:
+        yield _fake_proto(previous)
+
+
+async def _fake_proto_stream_async(chunks):
+    previous = None
+    async for chunk in chunks:
+        if previous is not None:
+            yield _fake_proto(previous, finished=False)
+        previous = chunk
+    if previous is not None:
+        yield _fake_proto(previous)
+
+
+class FakeGenerativeServiceClient:
+    """`GenerativeServiceClient` look-alike served by a `FakeGenerativeModel`.
+
+    Like the real client it returns `GenerateContentResponse` protos, streamed
+    ones as an iterable of them.
+    """
+
+    def __init__(self, model: FakeGenerativeModel | None = None, **kwargs):
+        self.model = FakeGenerativeModel.from_env() if model is None else model
+
+    def generate_content(self, request: Any = None, *, contents: Any = None, metadata=(), **kwargs):
+        return _fake_proto(self.model.generate_content(contents if request is None else request))
+
+    def stream_generate_content(self, request: Any = None, *, contents: Any = None, metadata=(), **kwargs):
+        return _fake_proto_stream(self.model.generate_content(contents if request is None else request, stream=True))
+
+
+class FakeGenerativeServiceAsyncClient(FakeGenerativeServiceClient):
+    async def generate_content(self, request: Any = None, *, contents: Any = None, metadata=(), **kwargs):
+        return _fake_proto(await self.model.generate_content_async(contents if request is None else request))
+
+    async def stream_generate_content(self, request: Any = None, *, contents: Any = None, metadata=(), **kwargs):
+        chunks = await self.model.generate_content_async(contents if request is None else request, stream=True)
+        return _fake_proto_stream_async(chunks)
+
+
+class BackgroundModel:
+    """Loads a model on a background thread so the server can start serving first.
+
+    Attribute access is forwarded to the loaded model and blocks until loading
+    finishes, re-raising a load failure. `status()` never blocks, for readiness
+    checks.
+    """
+
+    def __init__(self, load: Callable[[], Any], name: str = 'model'):
+        self._load = load
+        self._name = name
+        self._model = None
+        self._error: BaseException | None = None
+        self._done = threading.Event()
+
+    def start(self) -> BackgroundModel:
+        threading.Thread(target=self._run, name='aibot-model-init', daemon=True).start()
+        return self
+
+    def _run(self) -> None:
+        started = _perf_counter()
+        try:
+            self._model = self._load()
+        except BaseException as e:
+            self._error = e
+            error('Model initialization failed: {0!r}'.format(e))
+        finally:
+            IMPORT_PROFILE[self._name + ' init'] = _perf_counter() - started
+            self._done.set()
+        if self._error is None:
+            info('Model ready in {0:.2f}s'.format(IMPORT_PROFILE[self._name + ' init']))
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+    def status(self) -> str:
+        if not self._done.is_set():
+            return 'loading'
+        return 'failed' if self._error is not None else 'ready'
+
+    def __getattr__(self, name: str) -> Any:
+        self._done.wait()
+        if self._error is not None:
+            raise RuntimeError('Model failed to initialize') from self._error
+        return getattr(self._model, name)
+
+
+if os.environ.get('AI_BACKEND') == 'fake':
+    aiLib = BackgroundModel(FakeGenerativeModel.from_env).start()
+else:
+    aiLib = BackgroundModel(lambda: training_model.train(__repr__ = 'RECURSIVE CHATTER').self).start()
+IMPORT_PROFILE['utils'] = _perf_counter() - _import_started
+
+
+class ModelRegistry:
+    """Creates one model per tier on first use.
+
+    Tiers are built with the fake backend's `FakeGenerativeModel` or with
+    AILibrary's `GenerativeModel`; `check()` fails fast at start-up when a
+    configured tier can't be built.
+    """
+
+    def __init__(self, default: Any):
+        self.models: dict[str | None, Any] = {None: default}
+        self.lock = threading.Lock()
+
+    def check(self, names: Iterable[str | None]) -> None:
+        """Raises at start-up, rather than on the first reply, if a named tier can't be built."""
+        if any(name is not None for name in names):
+            self._factory()
+
+    def get(self, name: str | None) -> Any:
+        model = self.models.get(name)
+        if model is None:
+            with self.lock:
+                model = self.models.get(name)
+                if model is None:
+                    model = self.models[name] = self._factory()(name)
+        return model
+
+    def _factory(self) -> Callable[[str], Any]:
+        if os.environ.get('AI_BACKEND') == 'fake':
+            return _fake_model
+        # AILibrary is star-imported, so check for the class instead of assuming it.
+        factory = globals().get('GenerativeModel')
+        if factory is None:
+            raise RuntimeError('Generation profiles name model tiers, but AILibrary has no GenerativeModel')
+        return factory
+
+
+def _fake_model(name: str) -> FakeGenerativeModel:
+    model = FakeGenerativeModel.from_env()
+    model.model_name = name
+    return model
 
-# AI generators
 
-aiLib = training_model.train(__repr__ = 'RECURSIVE CHATTER').self
 from __future__ import annotations
 from typing import Any, Dict, Optional, Tuple, Union
 
@@ -2246,6 +2520,114 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             auth._default._get_gce_credentials = get_gce
 
 
+    DISCOVERY_VERSION = "v1beta"
+    DISCOVERY_CACHE_TTL = float(os.getenv("AI_DISCOVERY_CACHE_TTL", 24 * 3600))
+    # Per user: the cached document supplies the URL the API key is sent to.
+    DISCOVERY_CACHE_DIR = os.getenv(
+        "AI_DISCOVERY_CACHE_DIR",
+        os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "ailib-discovery"),
+    )
+
+    # Cache key -> (fetched at, parsed discovery document).
+    _discovery_docs: dict[str, tuple[float, dict]] = {}
+    _discovery_lock = threading.Lock()
+    # httplib2.Http keeps connections alive but isn't thread-safe, so each thread gets its own,
+    # along with the discovery resources bound to it.
+    _http_local = threading.local()
+
+
+    def _shared_http() -> httplib2.Http:
+        http = getattr(_http_local, "http", None)
+        if http is None:
+            http = _http_local.http = httplib2.Http()
+        return http
+
+
+    def _private_cache_dir() -> bool:
+        """Creates DISCOVERY_CACHE_DIR if needed and says whether only we can write to it."""
+        try:
+            os.makedirs(DISCOVERY_CACHE_DIR, mode=0o700, exist_ok=True)
+            st = os.lstat(DISCOVERY_CACHE_DIR)
+        except OSError:
+            return False
+        owner = os.getuid() if hasattr(os, "getuid") else st.st_uid
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != owner or st.st_mode & 0o077:
+            warning(f"Not using discovery cache {DISCOVERY_CACHE_DIR}: it must be a directory private to this user")
+            return False
+        return True
+
+
+    def _discovery_cache_key(ecid: str) -> str:
+        key_hash = hashlib.sha256(ecid.encode()).hexdigest()[:16]
+        return f"{DISCOVERY_VERSION}-{__version__}-{key_hash}"
+
+
+    def _discovery_document(ecid: str, metadata: dict | Sequence[tuple[str, str]] = ()) -> dict:
+        """Returns the parsed File API discovery document, fetching it at most once per TTL.
+
+        Documents are cached in-process and as raw JSON under DISCOVERY_CACHE_DIR,
+        keyed by API version, library version and a hash of the API key, so
+        restarts and new clients skip the network round trip. The disk cache is
+        skipped unless the directory is owned by us and closed to everyone else.
+        """
+        cache_key = _discovery_cache_key(ecid)
+        now = time.time()
+        with _discovery_lock:
+            cached = _discovery_docs.get(cache_key)
+            if cached is not None and now - cached[0] < DISCOVERY_CACHE_TTL:
+                return cached[1]
+
+            path = os.path.join(DISCOVERY_CACHE_DIR, cache_key + ".json")
+            use_disk = _private_cache_dir()
+            try:
+                if not use_disk:
+                    raise FileNotFoundError(path)
+                fetched = os.path.getmtime(path)
+                if now - fetched >= DISCOVERY_CACHE_TTL:
+                    raise FileNotFoundError(path)
+                with open(path, encoding="utf-8") as fp:
+                    document = json.load(fp)
+            except (OSError, ValueError):
+                request = aiLibapiclient.http.HttpRequest(
+                    http=_shared_http(),
+                    postproc=lambda resp, content: (resp, content),
+                    uri=f"{GENAI_API_DISCOVERY_URL}?version={DISCOVERY_VERSION}&key={ecid}",
+                    headers=dict(metadata),
+                )
+                response, content = request.execute()
+                raw, fetched = content.decode("utf-8"), now
+                document = json.loads(raw)
+                if use_disk:
+                    try:
+                        fd, tmp = tempfile.mkstemp(dir=DISCOVERY_CACHE_DIR, suffix=".tmp")
+                        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                            fp.write(raw)
+                        os.replace(tmp, path)
+                    except OSError:
+                        pass
+
+            _discovery_docs[cache_key] = (fetched, document)
+            return document
+
+
+    def _discovery_resource(ecid: str, metadata: dict | Sequence[tuple[str, str]] = ()):
+        """Returns the File API resource built from the discovery document.
+
+        Building walks the whole document, so it is done once per document and
+        thread rather than per client; the resource is bound to the thread's Http.
+        """
+        document = _discovery_document(ecid, metadata)
+        resources = getattr(_http_local, "resources", None)
+        if resources is None:
+            resources = _http_local.resources = {}
+        cache_key = _discovery_cache_key(ecid)
+        cached = resources.get(cache_key)
+        if cached is None or cached[0] is not document:
+            resource = aiLibapiclient.discovery.build_from_document(document, developerKey=ecid, http=_shared_http())
+            cached = resources[cache_key] = (document, resource)
+        return cached[1]
+
+
     class FileServiceClient(glm.FileServiceClient):
         def __init__(self, *args, **kwargs):
             self._discovery_api = None
@@ -2258,19 +2640,7 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
                     "Invalid operation: Uploading to the File API requires an API key. Please provide a valid API key."
                 )
 
-            request = aiLibapiclient.http.HttpRequest(
-                http=httplib2.Http(),
-                postproc=lambda resp, content: (resp, content),
-                uri=f"{GENAI_API_DISCOVERY_URL}?version=v1beta&key={ecid}",
-                headers=dict(metadata),
-            )
-            response, content = request.execute()
-            request.http.close()
-
-            discovery_doc = content.decode("utf-8")
-            self._discovery_api = aiLibapiclient.discovery.build_from_document(
-                discovery_doc, developerKey=ecid
-            )
+            self._discovery_api = _discovery_resource(ecid, metadata)
 
         def create_file(
             self,
@@ -2282,8 +2652,8 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             resumable: bool = True,
             metadata: Sequence[tuple[str, str]] = (),
         ) -> protos.File:
-            if self._discovery_api is None:
-                self._setup_discovery_api(metadata)
+            # A lookup once built; clients can be shared across threads, so take this thread's resource.
+            self._setup_discovery_api(metadata)
 
             file = {}
             if name is not None:
@@ -2303,23 +2673,250 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             request = self._discovery_api.media().upload(body={"file": file}, media_body=media)
             for key, value in metadata:
                 request.headers[key] = value
-            result = request.execute()
+            # The calling thread's pooled connection, since clients can be shared across threads.
+            result = request.execute(http=_shared_http())
 
             return self.get_file({"name": result["file"]["name"]})
 
 
+    try:
+        import httpx
+    except ImportError:
+        httpx = None
+
+    # Resumable upload chunks must be multiples of this, except the last one.
+    UPLOAD_CHUNK_GRANULARITY = 256 * 1024
+
+
+    class UploadInterrupted(Exception):
+        """Raised when a resumable upload gives up; pass `upload_url` back to `create_file` to resume."""
+
+        def __init__(self, upload_url: str, offset: int):
+            super().__init__(f"Upload interrupted at byte {offset}; resume with upload_url={upload_url!r}")
+            self.upload_url = upload_url
+            self.offset = offset
+
+
+    def _retryable_status(status: int) -> bool:
+        # Request timeouts and rate limiting clear up on their own, like server errors.
+        return status in (408, 429) or status >= 500
+
+
+    def _retry_delay(e: Exception, retries: int) -> float:
+        """Exponential backoff with jitter, or the server's Retry-After if it asks for longer."""
+        delay = min(2 ** retries, 30) * random.uniform(0.5, 1.0)
+        if isinstance(e, httpx.HTTPStatusError):
+            try:
+                delay = max(delay, min(float(e.response.headers.get("Retry-After", 0)), 60))
+            except ValueError:
+                pass
+        return delay
+
+
     class FileServiceAsyncClient(glm.FileServiceAsyncClient):
-        async def create_file(self, *args, **kwargs):
-            raise NotImplementedError(
-                "The `create_file` method is currently not supported for the asynchronous client."
+        async def create_file(
+            self,
+            path: str | pathlib.Path | os.PathLike | IOBase,
+            *,
+            mime_type: str | None = None,
+            name: str | None = None,
+            display_name: str | None = None,
+            chunk_size: int = 8 * 1024 * 1024,
+            upload_url: str | None = None,
+            max_retries: int = 5,
+            metadata: Sequence[tuple[str, str]] = (),
+        ) -> protos.File:
+            """Uploads a file with the resumable upload protocol, one chunk in memory at a time.
+
+            Chunks failed by the network, a 408, a 429 or a 5xx are retried from the
+            offset the server last acknowledged. If retries run out, or the server
+            rejects a chunk outright, `UploadInterrupted` carries the `upload_url` to pass
+            back in to continue the same upload later. File objects must be seekable
+            to resume. Requires `httpx`.
+            """
+            if httpx is None:
+                raise ImportError("Asynchronous uploads require `httpx`: pip install httpx")
+            ecid = self._client._client_options.ecid
+            if ecid is None:
+                raise ValueError(
+                    "Invalid operation: Uploading to the File API requires an API key. Please provide a valid API key."
+                )
+            chunk_size = max(1, chunk_size // UPLOAD_CHUNK_GRANULARITY) * UPLOAD_CHUNK_GRANULARITY
+
+            if isinstance(path, IOBase):
+                fp, close = path, False
+                mime_type = mime_type or "application/octet-stream"
+            else:
+                fp, close = await asyncio.to_thread(open, path, "rb"), True
+                mime_type = mime_type or mimetypes.guess_type(os.fspath(path))[0] or "application/octet-stream"
+            try:
+                start = await asyncio.to_thread(fp.tell)
+                size = await asyncio.to_thread(fp.seek, 0, os.SEEK_END) - start
+                await asyncio.to_thread(fp.seek, start)
+
+                headers = dict(metadata)
+                async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0)) as http:
+                    if upload_url is None:
+                        upload_url = await self._start_upload(
+                            http, ecid, headers, size, mime_type, name, display_name, metadata
+                        )
+                        offset = 0
+                    else:
+                        offset = await self._acknowledged_offset(http, upload_url, headers)
+                    result = await self._upload_chunks(
+                        http, upload_url, headers, fp, start, offset, size, chunk_size, max_retries
+                    )
+            finally:
+                if close:
+                    await asyncio.to_thread(fp.close)
+
+            return await self.get_file({"name": result["file"]["name"]})
+
+        async def _start_upload(self, http, ecid, headers, size, mime_type, name, display_name, metadata):
+            # The discovery document is cached, so this only blocks a thread on the first upload.
+            document = await asyncio.to_thread(_discovery_document, ecid, metadata)
+            root = document.get("rootUrl", "https://generativelanguage.googleapis.com/")
+            file = {}
+            if name is not None:
+                file["name"] = name
+            if display_name is not None:
+                file["displayName"] = display_name
+
+            response = await http.post(
+                f"{root}upload/{DISCOVERY_VERSION}/files",
+                params={"key": ecid},
+                json={"file": file},
+                headers={
+                    **headers,
+                    "X-Goog-Upload-Protocol": "resumable",
+                    "X-Goog-Upload-Command": "start",
+                    "X-Goog-Upload-Header-Content-Length": str(size),
+                    "X-Goog-Upload-Header-Content-Type": mime_type,
+                },
             )
+            response.raise_for_status()
+            return response.headers["X-Goog-Upload-URL"]
+
+        async def _upload_chunks(self, http, upload_url, headers, fp, start, offset, size, chunk_size, max_retries):
+            retries = 0
+            while True:
+                await asyncio.to_thread(fp.seek, start + offset)
+                chunk = await asyncio.to_thread(fp.read, chunk_size)
+                last = offset + len(chunk) >= size
+                try:
+                    response = await http.post(
+                        upload_url,
+                        content=chunk,
+                        headers={
+                            **headers,
+                            "X-Goog-Upload-Command": "upload, finalize" if last else "upload",
+                            "X-Goog-Upload-Offset": str(offset),
+                        },
+                    )
+                    response.raise_for_status()
+                except httpx.HTTPError as e:
+                    if isinstance(e, httpx.HTTPStatusError) and not _retryable_status(e.response.status_code):
+                        raise UploadInterrupted(upload_url, offset) from e
+                    retries += 1
+                    if retries > max_retries:
+                        raise UploadInterrupted(upload_url, offset) from e
+                    await asyncio.sleep(_retry_delay(e, retries))
+                    try:
+                        offset = await self._acknowledged_offset(http, upload_url, headers)
+                    except httpx.HTTPError:
+                        pass
+                    continue
+                if last:
+                    return response.json()
+                offset += len(chunk)
+                retries = 0
+
+        async def _acknowledged_offset(self, http, upload_url, headers) -> int:
+            response = await http.post(upload_url, headers={**headers, "X-Goog-Upload-Command": "query"})
+            response.raise_for_status()
+            return int(response.headers.get("X-Goog-Upload-Size-Received", 0))
+
+
+    class _DefaultMetadataMethod:
+        """Appends the client's default metadata to a method's `metadata` argument.
+
+        The wrapper is built the first time the attribute is read on a client and
+        stored on the instance, so later lookups bypass this descriptor entirely.
+        """
+
+        def __set_name__(self, owner, name):
+            self.owner = owner
+            self.name = name
+
+        def __get__(self, client, owner=None):
+            if client is None:
+                return self
+            f = getattr(super(self.owner, client), self.name)
+            defaults = client._default_metadata
+
+            def call(*args, metadata=(), **kwargs):
+                return f(*args, **kwargs, metadata=(*metadata, *defaults) if metadata else defaults)
+
+            client.__dict__[self.name] = call
+            return call
+
+
+    def _accepts_metadata(name, f):
+        if name.startswith("_"):
+            return False
+
+        if not callable(f):
+            return False
+
+        if "metadata" not in inspect.signature(f).parameters.keys():
+            return False
+
+        return True
+
+
+    # Client class -> subclass with its metadata-taking methods wrapped, built once per class.
+    _metadata_client_classes: dict[type, type] = {}
+
+
+    def _with_default_metadata(cls):
+        subclass = _metadata_client_classes.get(cls)
+        if subclass is None:
+            namespace = {
+                name: _DefaultMetadataMethod()
+                for name, value in inspect.getmembers(cls)
+                if _accepts_metadata(name, value)
+            }
+            namespace["__module__"] = cls.__module__
+            namespace["__qualname__"] = cls.__qualname__
+            subclass = type(cls)(cls.__name__, (cls,), namespace)
+            _metadata_client_classes[cls] = subclass
+        return subclass
 
 
     @dataclasses.dataclass
     class _ClientManager:
+        """Builds and pools the default service clients.
+
+        Sync clients are kept in `pool_size` slots per service and each thread
+        sticks to one slot. Async clients are bound to the event loop they were
+        created on, so each running loop gets its own. Each slot (or, for async
+        clients, each service) has its own build lock, so concurrent first calls
+        never create duplicates and a slow build doesn't hold up other services.
+        `lock` only guards the bookkeeping dicts and is never held while building.
+        """
+
         client_config: dict[str, Any] = dataclasses.field(default_factory=dict)
         default_metadata: Sequence[tuple[str, str]] = ()
-        clients: dict[str, Any] = dataclasses.field(default_factory=dict)
+        backend: str | None = None
+        pool_size: int = 1
+        pool_sizes: dict[str, int] = dataclasses.field(default_factory=dict)
+        clients: dict[str, list] = dataclasses.field(default_factory=dict)
+        loop_clients: weakref.WeakKeyDictionary = dataclasses.field(default_factory=weakref.WeakKeyDictionary)
+        requests: dict[str, int] = dataclasses.field(default_factory=dict)
+        lock: threading.RLock = dataclasses.field(default_factory=threading.RLock)
+        build_locks: dict[tuple, threading.Lock] = dataclasses.field(default_factory=dict)
+        local: threading.local = dataclasses.field(default_factory=threading.local)
+        threads: int = 0
 
         def configure(
             self,
@@ -2336,6 +2933,8 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             client_options: client_options_lib.ClientOptions | dict[str, Any] | None = None,
             client_info: gapic_v1.client_info.ClientInfo | None = None,
             default_metadata: Sequence[tuple[str, str]] = (),
+            backend: str | None = None,
+            pool_size: int | dict[str, int] | None = None,
         ) -> None:
             """Initializes default client configurations using specified parameters or environment variables.
 
@@ -2354,6 +2953,12 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
                     are set, they will be used in this order of priority.
                 default_metadata: Default (key, value) metadata pairs to send with every request.
                     when using `transport="rest"` these are sent as HTTP headers.
+                backend: `"fake"` serves the generative clients from an offline
+                    `FakeGenerativeModel` configured by the `FAKE_AI_*` environment variables.
+                    If omitted, the `AI_BACKEND` environment variable is used.
+                pool_size: Number of sync clients kept per service, either one number for
+                    every service or a `{service: size}` dict (other services get 1). If
+                    omitted, the `AI_CLIENT_POOL_SIZE` environment variable is used.
             """
             if isinstance(client_options, dict):
                 client_options = client_options_lib.from_dict(client_options)
@@ -2400,11 +3005,27 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             client_config = {key: value for key, value in client_config.items() if value is not None}
 
             self.client_config = client_config
-            self.default_metadata = default_metadata
+            # Frozen once here; every wrapped call reuses this tuple.
+            self.default_metadata = tuple(default_metadata)
+            self.backend = backend if backend is not None else os.getenv("AI_BACKEND")
+            if pool_size is None:
+                pool_size = int(os.getenv("AI_CLIENT_POOL_SIZE", 1))
+            if isinstance(pool_size, dict):
+                self.pool_size, self.pool_sizes = 1, {key.lower(): value for key, value in pool_size.items()}
+            else:
+                self.pool_size, self.pool_sizes = pool_size, {}
 
-            self.clients = {}
+            with self.lock:
+                self.clients = {}
+                self.loop_clients = weakref.WeakKeyDictionary()
+                self.requests = {}
 
         def make_client(self, name):
+            if self.backend == "fake" and name in ("generative", "generative_async"):
+                if name == "generative_async":
+                    return FakeGenerativeServiceAsyncClient()
+                return FakeGenerativeServiceClient()
+
             if name == "file":
                 cls = FileServiceClient
             elif name == "file_async":
@@ -2419,6 +3040,9 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             if not self.client_config:
                 configure()
 
+            if self.default_metadata:
+                cls = _with_default_metadata(cls)
+
             try:
                 with patch_colab_gce_credentials():
                     client = cls(**self.client_config)
@@ -2431,35 +3055,8 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
                 )
                 raise e
 
-            if not self.default_metadata:
-                return client
-
-            def keep(name, f):
-                if name.startswith("_"):
-                    return False
-
-                if not callable(f):
-                    return False
-
-                if "metadata" not in inspect.signature(f).parameters.keys():
-                    return False
-
-                return True
-
-            def add_default_metadata_wrapper(f):
-                def call(*args, metadata=(), **kwargs):
-                    metadata = list(metadata) + list(self.default_metadata)
-                    return f(*args, **kwargs, metadata=metadata)
-
-                return call
-
-            for name, value in inspect.getmembers(cls):
-                if not keep(name, value):
-                    continue
-                f = getattr(client, name)
-                f = add_default_metadata_wrapper(f)
-                setattr(client, name, f)
-
+            if self.default_metadata:
+                client._default_metadata = self.default_metadata
             return client
 
         def get_default_client(self, name):
@@ -2467,20 +3064,120 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             if name == "operations":
                 return self.get_default_operations_client()
 
-            client = self.clients.get(name)
+            if name.endswith("_async"):
+                with self.lock:
+                    self.requests[name] = self.requests.get(name, 0) + 1
+                return self._loop_client(name)
+
+            with self.lock:
+                self.requests[name] = self.requests.get(name, 0) + 1
+                slots = self._slots(name)
+            index = self._thread_slot() % len(slots)
+            client = slots[index]
             if client is None:
-                client = self.make_client(name)
-                self.clients[name] = client
+                client = self._build_slot(name, slots, index)
+            return client
+
+        def _slots(self, name):
+            # Callers hold `lock`.
+            slots = self.clients.get(name)
+            if slots is None:
+                slots = self.clients[name] = [None] * self.pool_sizes.get(name, self.pool_size)
+            return slots
+
+        def _build_lock(self, *key) -> threading.Lock:
+            with self.lock:
+                return self.build_locks.setdefault(key, threading.Lock())
+
+        def _build_slot(self, name, slots, index):
+            with self._build_lock(name, index):
+                client = slots[index]
+                if client is None:
+                    client = self.make_client(name)
+                    with self.lock:
+                        slots[index] = client
+            return client
+
+        def _thread_slot(self) -> int:
+            slot = getattr(self.local, "slot", None)
+            if slot is None:
+                with self.lock:
+                    slot = self.local.slot = self.threads
+                    self.threads += 1
+            return slot
+
+        def _loop_client(self, name):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is None:
+                # Outside a loop the client binds to whichever loop first awaits it; keep one for that case.
+                return self._loop_clients(self.clients, name)
+            with self.lock:
+                clients = self.loop_clients.get(loop)
+                if clients is None:
+                    clients = self.loop_clients[loop] = {}
+            return self._loop_clients(clients, name)
+
+        def _loop_clients(self, clients, name):
+            client = clients.get(name)
+            if client is None:
+                with self._build_lock(name):
+                    client = clients.get(name)
+                    if client is None:
+                        client = self.make_client(name)
+                        with self.lock:
+                            clients[name] = client
             return client
 
         def get_default_operations_client(self) -> operations_v1.OperationsClient:
             client = self.clients.get("operations", None)
             if client is None:
-                model_client = self.get_default_client("Model")
-                client = model_client._transport.operations_client
-                self.clients["operations"] = client
+                with self._build_lock("operations"):
+                    client = self.clients.get("operations", None)
+                    if client is None:
+                        model_client = self.get_default_client("Model")
+                        client = model_client._transport.operations_client
+                        with self.lock:
+                            self.clients["operations"] = client
             return client
 
+        def warm_up(self, names: Iterable[str], timeout: float | None = 10.0) -> None:
+            """Builds every pooled slot of the given sync services and connects their channels.
+
+            Only gRPC transports open a channel up front; REST clients are just built.
+            """
+            for name in names:
+                name = name.lower()
+                with self.lock:
+                    slots = self._slots(name)
+                for index in range(len(slots)):
+                    self._build_slot(name, slots, index)
+                for client in slots:
+                    channel = getattr(getattr(client, "_transport", None), "grpc_channel", None)
+                    if channel is not None:
+                        import grpc
+
+                        grpc.channel_ready_future(channel).result(timeout=timeout)
+
+        def pool_stats(self) -> dict[str, dict[str, int]]:
+            """Per service: pool size, clients built, and how often a client was handed out."""
+            with self.lock:
+                stats = {}
+                for name, slots in self.clients.items():
+                    # Async clients made outside a loop and the operations client aren't pooled.
+                    slots = slots if isinstance(slots, list) else [slots]
+                    stats[name] = {"size": len(slots), "created": sum(c is not None for c in slots)}
+                for clients in self.loop_clients.values():
+                    for name in clients:
+                        entry = stats.setdefault(name, {"size": 0, "created": 0})
+                        entry["size"] += 1
+                        entry["created"] += 1
+                for name, count in self.requests.items():
+                    stats.setdefault(name, {"size": 0, "created": 0})["requests"] = count
+                return stats
+
 
     def configure(
         *,
@@ -2495,6 +3192,8 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
         client_options: client_options_lib.ClientOptions | dict | None = None,
         client_info: gapic_v1.client_info.ClientInfo | None = None,
         default_metadata: Sequence[tuple[str, str]] = (),
+        backend: str | None = None,
+        pool_size: int | dict[str, int] | None = None,
     ):
         """Captures default client configuration.
 
@@ -2509,6 +3208,8 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
                 used.
             default_metadata: Default (key, value) metadata pairs to send with every request.
                 when using `transport="rest"` these are sent as HTTP headers.
+            backend: `"fake"` to serve generative clients from an offline `FakeGenerativeModel`.
+            pool_size: Sync clients kept per service, as a number or a `{service: size}` dict.
         """
         return _client_manager.configure(
             ecid=ecid,
@@ -2517,11 +3218,16 @@ class generate_text(Message, PartialMessage, Hashable, Thread):
             client_options=client_options,
             client_info=client_info,
             default_metadata=default_metadata,
+            backend=backend,
+            pool_size=pool_size,
         )
 
 
     _client_manager = _ClientManager()
     _client_manager.configure()
+    if os.getenv("AI_CLIENT_WARMUP"):
+        # Comma-separated services to build and connect now rather than on the first request.
+        _client_manager.warm_up(os.getenv("AI_CLIENT_WARMUP").split(","))
 
 
     def get_default_cache_client() -> glm.CacheServiceClient: